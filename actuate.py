@@ -0,0 +1,303 @@
+import argparse
+import ctypes
+import ctypes.util
+import os
+import re
+import select
+import shlex
+import subprocess
+import sys
+import time
+from collections import deque
+import numpy as np
+import instrument
+
+# shell that stands in for 'adb shell': input taps are accepted and ignored
+STUB_COMMAND = ['sh', '-c', 'input() { :; }; while IFS= read -r line; do eval "$line"; done']
+
+# line printed by the device shell after a batch of taps
+DONE_MARKER = 'taps-done'
+
+
+class ActuatorBackend():
+    """Base class of the click backends.
+    A backend clicks positions in its own coordinates (see target) and
+    records the time from issuing a batch of clicks until the backend
+    reports the whole batch as performed.
+    """
+    name = 'base'
+
+    def __init__(self):
+        self.latencies = deque(maxlen=1000)
+        self.n_clicks = 0
+        self.n_batches = 0
+
+    def target(self, x, y, screen):
+        """Converts a position of the 750 px high game image into the coordinates of the backend
+
+        Args:
+            x (float): x position in the game image
+            y (float): y position in the game image
+            screen: frame source with x, y and scale
+
+        Returns:
+            tuple: position on the desktop
+        """
+        return (x*screen.scale+screen.x, y*screen.scale+screen.y)
+
+    def click(self, positions):
+        """Clicks positions one after the other
+
+        Args:
+            positions (list): (x, y) positions in the coordinates of the backend
+        """
+        if len(positions) == 0:
+            return
+        start_time = time.perf_counter()
+        self._click(positions)
+        latency = time.perf_counter()-start_time
+        self.latencies.append(latency)
+        self.n_clicks += len(positions)
+        self.n_batches += 1
+        instrument.record('actuate.'+self.name, latency)
+
+    def _click(self, positions):
+        raise NotImplementedError
+
+    def stats(self):
+        """Returns the issue to completion latency of the last batches
+
+        Returns:
+            dict: backend, number of clicks and batches, mean, p95 and max batch latency in seconds
+        """
+        if len(self.latencies) == 0:
+            return {'backend': self.name, 'count': self.n_clicks, 'batches': 0, 'mean': 0, 'p95': 0, 'max': 0}
+        latencies = np.array(self.latencies)
+        return {
+            'backend': self.name,
+            'count': self.n_clicks,
+            'batches': self.n_batches,
+            'mean': latencies.mean(),
+            'p95': np.percentile(latencies, 95),
+            'max': latencies.max()
+        }
+
+    def close(self):
+        pass
+
+
+class PynputActuator(ActuatorBackend):
+    """Moves the pointer and clicks with pynput, one event round trip per click (portable fallback)
+    """
+    name = 'pynput'
+
+    def __init__(self):
+        super().__init__()
+        from pynput.mouse import Button, Controller
+        self.mouse = Controller()
+        self.button = Button.left
+
+    def _click(self, positions):
+        for position in positions:
+            self.mouse.position = position
+            self.mouse.click(self.button, 1)
+
+
+class XTestActuator(ActuatorBackend):
+    """Clicks through the XTest extension of the X server.
+    The motion and button events of all clicks of a frame are queued and sent
+    in one request buffer, one XSync waits until the server has processed them.
+    """
+    name = 'xtest'
+
+    def __init__(self, display=None):
+        super().__init__()
+        if not sys.platform.startswith('linux'):
+            raise OSError('XTest clicks are only available on linux')
+        if display is None and 'DISPLAY' not in os.environ:
+            raise OSError('no X display available')
+        self.xlib = self._load('X11')
+        self.xtst = self._load('Xtst')
+        self._set_signatures()
+        self.display = self.xlib.XOpenDisplay(display.encode() if display else None)
+        if not self.display:
+            raise OSError('cannot open X display')
+        if not self.xtst.XTestQueryExtension(self.display, ctypes.byref(ctypes.c_int()), ctypes.byref(ctypes.c_int()),
+                                             ctypes.byref(ctypes.c_int()), ctypes.byref(ctypes.c_int())):
+            self.xlib.XCloseDisplay(self.display)
+            self.display = None
+            raise OSError('X server does not support the XTEST extension')
+
+    @staticmethod
+    def _load(name):
+        path = ctypes.util.find_library(name)
+        if path is None:
+            raise OSError('lib'+name+' not found')
+        return ctypes.CDLL(path)
+
+    def _set_signatures(self):
+        xlib = self.xlib
+        xtst = self.xtst
+        xlib.XOpenDisplay.restype = ctypes.c_void_p
+        xlib.XOpenDisplay.argtypes = [ctypes.c_char_p]
+        xlib.XCloseDisplay.argtypes = [ctypes.c_void_p]
+        xlib.XSync.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        xtst.XTestQueryExtension.argtypes = [ctypes.c_void_p]+[ctypes.POINTER(ctypes.c_int)]*4
+        xtst.XTestFakeMotionEvent.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_ulong]
+        xtst.XTestFakeButtonEvent.argtypes = [ctypes.c_void_p, ctypes.c_uint, ctypes.c_int, ctypes.c_ulong]
+
+    def _click(self, positions):
+        for x, y in positions:
+            # screen -1 is the screen of the pointer
+            self.xtst.XTestFakeMotionEvent(self.display, -1, int(x), int(y), 0)
+            self.xtst.XTestFakeButtonEvent(self.display, 1, 1, 0)
+            self.xtst.XTestFakeButtonEvent(self.display, 1, 0, 0)
+        self.xlib.XSync(self.display, 0)
+
+    def close(self):
+        if self.display is None:
+            return
+        self.xlib.XCloseDisplay(self.display)
+        self.display = None
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+class ShellTapActuator(ActuatorBackend):
+    """Taps the device directly with 'input tap' through a persistent 'adb shell'.
+    The taps of a frame are written in one line followed by an echo, the
+    batch is complete when the device shell prints the marker. The positions
+    are device pixels: the position on the frame of a device.DeviceScreen
+    scaled from the stream to the screen size. Without a device stream the
+    game is assumed to fill the height of the device screen.
+    """
+    name = 'shell'
+
+    def __init__(self, command=('adb', 'shell'), device_size=None, timeout=2.0):
+        """
+        Args:
+            command (list, optional): command that starts the device shell, e.g. STUB_COMMAND
+            device_size (tuple, optional): width and height of the device screen in pixels, asked with 'wm size' if None
+            timeout (float, optional): seconds to wait for the device shell to confirm a batch
+        """
+        super().__init__()
+        self.timeout = timeout
+        self.process = subprocess.Popen(list(command), stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        stderr=subprocess.DEVNULL, bufsize=0)
+        self.output = b''
+        if device_size is None:
+            size = re.search(r'(\d+)x(\d+)', self.run('wm size'))
+            if size is None:
+                self.close()
+                raise OSError('cannot read the device screen size')
+            device_size = (int(size.group(1)), int(size.group(2)))
+        self.device_size = device_size
+        self.scale = device_size[1]/750
+
+    def target(self, x, y, screen):
+        frame_size = getattr(screen, 'frame_size', None)
+        if frame_size is None:
+            return (x*self.scale, y*self.scale)
+        # the stream may have another resolution than the device screen
+        return ((x*screen.scale+screen.x)*self.device_size[0]/frame_size[0],
+                (y*screen.scale+screen.y)*self.device_size[1]/frame_size[1])
+
+    def run(self, command):
+        """Runs a command in the device shell
+
+        Args:
+            command (string): shell command
+
+        Returns:
+            string: output of the command
+        """
+        self.process.stdin.write((command+'; echo '+DONE_MARKER+'\n').encode())
+        marker = (DONE_MARKER+'\n').encode()
+        deadline = time.perf_counter()+self.timeout
+        while marker not in self.output:
+            remaining = deadline-time.perf_counter()
+            if remaining <= 0 or not select.select([self.process.stdout], [], [], remaining)[0]:
+                raise OSError('device shell does not respond')
+            data = os.read(self.process.stdout.fileno(), 4096)
+            if data == b'':
+                raise OSError('device shell has exited')
+            # adb shell may end the lines with \r\n
+            self.output += data.replace(b'\r\n', b'\n')
+        output, self.output = self.output.split(marker, 1)
+        return output.decode(errors='replace')
+
+    def _click(self, positions):
+        self.run('; '.join('input tap %d %d' % (int(x), int(y)) for x, y in positions))
+
+    def close(self):
+        if self.process is None:
+            return
+        self.process.stdin.close()
+        try:
+            self.process.wait(timeout=self.timeout)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.process = None
+
+
+BACKENDS = {
+    'xtest': XTestActuator,
+    'pynput': PynputActuator,
+    'shell': ShellTapActuator,
+}
+
+
+def make_actuator(name='auto', **options):
+    """Creates a click backend
+
+    Args:
+        name (string, optional): 'xtest', 'pynput', 'shell', 'stub' or 'auto'.
+            'auto' uses xtest if it is available and falls back to pynput.
+            'stub' is the shell backend with a local shell instead of the device.
+        **options: further arguments of the backend
+
+    Returns:
+        ActuatorBackend: click backend
+    """
+    if name == 'stub':
+        # the size of the simulated device frames of device.write_raw
+        options.setdefault('device_size', (422, 870))
+        return ShellTapActuator(STUB_COMMAND, **options)
+    if name != 'auto':
+        return BACKENDS[name](**options)
+    try:
+        return XTestActuator()
+    except OSError:
+        return PynputActuator()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measures the issue to completion latency of the click backends')
+    parser.add_argument('--backends', nargs='+', default=['stub'], choices=list(BACKENDS)+['stub'],
+                        help='backends to measure, the desktop backends really click')
+    parser.add_argument('--position', type=int, nargs=2, default=[0, 0], metavar=('X', 'Y'), help='clicked position')
+    parser.add_argument('--clicks', type=int, default=100, help='number of batches')
+    parser.add_argument('--batch', type=int, default=1, help='clicks per batch')
+    parser.add_argument('--command', help='device shell command of the shell backend, e.g. "adb -s SERIAL shell"')
+    args = parser.parse_args()
+
+    for backend_name in args.backends:
+        try:
+            if backend_name == 'shell' and args.command:
+                backend = make_actuator('shell', command=shlex.split(args.command))
+            else:
+                backend = make_actuator(backend_name)
+        except (OSError, ImportError) as error:
+            print(backend_name+': not available ('+str(error)+')')
+            continue
+        for _ in range(args.clicks):
+            backend.click([tuple(args.position)]*args.batch)
+        stats = backend.stats()
+        print('%-7s clicks %5d  batches %5d  batch latency: mean %.2f ms  p95 %.2f ms  max %.2f ms' % (
+            backend_name, stats['count'], stats['batches'], stats['mean']*1000, stats['p95']*1000, stats['max']*1000))
+        backend.close()
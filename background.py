@@ -0,0 +1,139 @@
+import cv2
+import numpy as np
+import util
+from instrument import span
+from workspace import get_buffer, get_zeros
+
+# pixels brighter than this belong to the white outline of a train
+BRIGHT = 180
+
+# minimal gray value difference of a pixel that changed from the background
+CHANGE_THRESHOLD = 40
+
+
+class Background():
+    """Static background model of the level for the train detection.
+    Tracks, stations and gates do not move after calibration, so a frame is
+    compared with the calibration frame and only pixels that changed on the
+    cells of the track graph reach the contour search. Changes without the
+    bright outline of a train (e.g. a train that has left the calibration
+    frame) are copied into the background. Every gate keeps both of its
+    appearances, so switching a gate is no change.
+    """
+
+    def __init__(self, img, mygrid, threshold=None, min_bright=0.1, max_scene_change=0.25, gate_radius=35):
+        """
+        Args:
+            img (RGB-image): calibration frame without trains (750 px high)
+            mygrid (Grid): grid calibrated on img
+            threshold (int, optional): minimal gray value difference of a changed pixel, CHANGE_THRESHOLD if None
+            min_bright (float, optional): minimal fraction of bright (outline) pixels of a train
+            max_scene_change (float, optional): maximal fraction of changed pixels outside the
+                track graph, above it the frame is no level frame and no stations are reported
+            gate_radius (int, optional): half size of the gate patches in pixels
+        """
+        self.threshold = threshold if threshold is not None else CHANGE_THRESHOLD
+        self.min_bright = min_bright
+        self.max_scene_change = max_scene_change
+        self.n_stations = mygrid.n_stations
+        self.gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+        self.mask = np.where(mygrid.cell_map >= 0, 255, 0).astype(np.uint8)
+        self.gates = [(mygrid.xs[gate], mygrid.ys[gate]) for gate in mygrid.gates]
+        self.gate_radius = gate_radius
+        self.levels = {}
+
+    def get_level(self, shape):
+        """Returns the background and the track mask at the resolution of a frame
+
+        Args:
+            shape (tuple): shape of the frame
+
+        Returns:
+            array: gray background
+            array: track mask, 255 on the cells of the track graph
+            array: sample of the pixels outside the track graph for the scene check
+            list: slices of the gate patches
+            list: other appearance of every gate patch
+        """
+        level = self.levels.get(shape[:2])
+        if level is None:
+            (height, width) = shape[:2]
+            if (height, width) == self.gray.shape:
+                background = self.gray.copy()
+                mask = self.mask
+            else:
+                background = cv2.resize(self.gray, (width, height), interpolation=cv2.INTER_AREA)
+                mask = cv2.resize(self.mask, (width, height), interpolation=cv2.INTER_NEAREST)
+            factor = height/self.gray.shape[0]
+            radius = int(self.gate_radius*factor)
+            patches = [(slice(max(int(y*factor)-radius, 0), int(y*factor)+radius+1),
+                        slice(max(int(x*factor)-radius, 0), int(x*factor)+radius+1)) for x, y in self.gates]
+            level = (background, mask, mask[::8, ::8] == 0, patches, [background[patch].copy() for patch in patches])
+            self.levels[shape[:2]] = level
+        return level
+
+    def find_candidates(self, img, workspace=None):
+        """Finds the trains that differ from the background, see util.find_candidates
+
+        Args:
+            img (RGB-image): screenshot of the game at any resolution
+            workspace (Workspace, optional): buffers of the gray, difference and threshold images
+
+        Returns:
+            list: list of train candidates with type, position, padding and contour
+            int: number of stations, 0 if the frame is no level frame
+            list: contours of all changed areas
+        """
+        background, mask, static, patches, alternates = self.get_level(img.shape)
+        (height, width) = background.shape
+        size = height*width
+        with span('find_items.threshold'):
+            gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY, dst=get_buffer(workspace, 'gray', background.shape))
+            diff = cv2.absdiff(gray, background, dst=get_buffer(workspace, 'diff', background.shape))
+            _, moving = cv2.threshold(diff, self.threshold, 255, cv2.THRESH_BINARY,
+                                      dst=get_buffer(workspace, 'moving', background.shape))
+        if np.count_nonzero(moving[::8, ::8][static]) > self.max_scene_change*np.count_nonzero(static):
+            return [], 0, []
+        cv2.bitwise_and(moving, mask, dst=moving)
+
+        for patch, alternate in zip(patches, alternates):
+            if cv2.countNonZero(moving[patch]) == 0:
+                continue
+            # a switched gate matches its other appearance
+            other = cv2.absdiff(gray[patch], alternate) > self.threshold
+            moving[patch] &= other.view(np.uint8)*255
+            changed = moving[patch] > 0
+            if np.any(changed) and not np.any(gray[patch][changed] > BRIGHT):
+                # no train on the gate and the gate shows its other state for the first time
+                alternate[:] = background[patch]
+                background[patch] = gray[patch]
+                moving[patch] = 0
+
+        with span('find_items.contours'):
+            contours, _ = cv2.findContours(moving, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            _, bright = cv2.threshold(gray, BRIGHT, 255, cv2.THRESH_BINARY,
+                                      dst=get_buffer(workspace, 'bright', background.shape))
+            cv2.bitwise_and(bright, moving, dst=bright)
+
+        candidates = []
+        absorbed = []
+        for contour in contours:
+            area = cv2.contourArea(contour)/size
+            (x, y, w, h) = cv2.boundingRect(contour)
+            if cv2.countNonZero(bright[y:y+h, x:x+w]) < self.min_bright*cv2.countNonZero(moving[y:y+h, x:x+w]):
+                # no train in the frame: a switched gate or a train that has left
+                absorbed.append(contour)
+                continue
+            moments = cv2.moments(contour)
+            if area < util.MIN_TRAIN_AREA or area >= util.MIN_STATION_AREA or moments['m00'] == 0:
+                continue
+            c_x = int(moments["m10"] / moments["m00"])
+            c_y = int(moments["m01"] / moments["m00"])
+            candidates.append({'type': 'train', 'x': c_x, 'y': c_y, 'padding': int(width/20), 'contour': contour})
+
+        if len(absorbed) > 0:
+            update = get_zeros(workspace, 'update', moving.shape)
+            cv2.drawContours(update, absorbed, -1, 255, cv2.FILLED)
+            np.copyto(background, gray, where=update > 0)
+
+        return candidates, self.n_stations, contours
@@ -0,0 +1,113 @@
+import time
+from collections import Counter
+
+# processing effort levels, higher levels do less work per frame
+EFFORT_FULL = 0
+EFFORT_NO_HOUGH = 1 # white trains are not checked for track lines
+EFFORT_REDUCED = 2 # trains are detected at reduced resolution
+EFFORT_NAMES = ['full', 'no-hough', 'reduced']
+
+
+class FrameCadence():
+    """Paces the game loop to a target frame interval.
+    Every frame has a deadline. Frames that overrun their deadline raise the
+    processing effort level, a long run of fast frames lowers it again. Spare
+    time before the next deadline is spent on background tasks, then the loop
+    sleeps until the deadline.
+    """
+
+    def __init__(self, interval=1/30, max_overruns=2, recover_frames=60, low_load=0.5, min_task_time=0.005,
+                 clock=time.perf_counter, sleep=time.sleep, efforts=(EFFORT_FULL, EFFORT_NO_HOUGH, EFFORT_REDUCED)):
+        """
+        Args:
+            interval (float, optional): target frame interval in seconds, None to run as fast as possible
+            max_overruns (int, optional): number of missed deadlines in a row that raise the effort level
+            recover_frames (int, optional): number of fast frames in a row that lower the effort level
+            low_load (float, optional): a frame is fast if it takes less than this fraction of the interval
+            min_task_time (float, optional): minimal spare time in seconds to start a background task
+            clock (callable, optional): wall clock in seconds
+            sleep (callable, optional): sleep function
+            efforts (tuple, optional): effort levels that save work in this configuration, lowest first
+        """
+        self.interval = interval
+        self.max_overruns = max_overruns
+        self.recover_frames = recover_frames
+        self.low_load = low_load
+        self.min_task_time = min_task_time
+        self.clock = clock
+        self.sleep = sleep
+        self.efforts = efforts
+        self.level = efforts[0]
+        self.deadline = None
+        self.start = None
+        self.overruns = 0
+        self.fast_frames = 0
+        self.n_frames = 0
+        self.n_missed = 0
+        self.n_tasks = 0
+        self.levels = Counter()
+        self.busy_time = 0.0
+
+    def begin(self):
+        """Starts a frame
+
+        Returns:
+            int: effort level for the frame
+        """
+        self.start = self.clock()
+        if self.interval is not None and (self.deadline is None or self.deadline < self.start):
+            self.deadline = self.start+self.interval
+        self.levels[self.level] += 1
+        return self.level
+
+    def end(self, tasks=None):
+        """Ends a frame: adapts the effort level, runs background tasks and waits for the deadline
+
+        Args:
+            tasks (deque, optional): background tasks, callables that are run in the spare time
+        """
+        now = self.clock()
+        self.n_frames += 1
+        self.busy_time += now-self.start
+        if self.interval is None:
+            if tasks:
+                tasks.popleft()()
+                self.n_tasks += 1
+            return
+
+        if now > self.deadline:
+            # no catching up, the next frame gets a full interval from now
+            self.deadline = now
+            self.n_missed += 1
+            self.overruns += 1
+            self.fast_frames = 0
+            if self.overruns >= self.max_overruns and self.level != self.efforts[-1]:
+                self.level = self.efforts[self.efforts.index(self.level)+1]
+                self.overruns = 0
+        else:
+            self.overruns = 0
+            if now-self.start < self.low_load*self.interval:
+                self.fast_frames += 1
+                if self.fast_frames >= self.recover_frames and self.level != self.efforts[0]:
+                    self.level = self.efforts[self.efforts.index(self.level)-1]
+                    self.fast_frames = 0
+            else:
+                self.fast_frames = 0
+
+        while tasks and self.deadline-self.clock() > self.min_task_time:
+            tasks.popleft()()
+            self.n_tasks += 1
+        remaining = self.deadline-self.clock()
+        if remaining > 0:
+            self.sleep(remaining)
+        self.deadline += self.interval
+
+    def report(self):
+        """Prints the number of frames, missed deadlines and the frames per effort level
+        """
+        if self.n_frames == 0:
+            return
+        print('frames: %d  missed deadlines: %d  load: %.0f%%  background tasks: %d' % (
+            self.n_frames, self.n_missed,
+            self.busy_time/(self.n_frames*self.interval)*100 if self.interval is not None else 100, self.n_tasks))
+        print('effort levels: '+'  '.join('%s %d' % (EFFORT_NAMES[level], self.levels[level]) for level in sorted(self.levels)))
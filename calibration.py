@@ -0,0 +1,161 @@
+import glob
+import json
+import os
+import cv2
+import numpy as np
+from grid import Grid
+from runlog import to_json
+
+# arrays and values that describe a calibrated grid
+GRID_ARRAYS = ['grid', 'types', 'xs', 'ys', 'adjacency', 'state', 'ostate', 'distance', 'incoming', 'gates', 'cell_map', 'distance_map']
+GRID_VALUES = ['n_stations', 'min_x', 'min_y', 'gridsize_x', 'gridsize_y']
+
+THUMBNAIL_SIZE = (16, 28)
+PATCH_RADIUS = 15
+
+
+def fingerprint(img):
+    """Returns a small grayscale thumbnail of a level frame
+
+    Args:
+        img (RGB-image): resized screenshot of the smartphone window
+
+    Returns:
+        array: thumbnail
+    """
+    gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+    return cv2.resize(gray, THUMBNAIL_SIZE, interpolation=cv2.INTER_AREA).astype(np.float32)
+
+
+def gate_patches(img, xs, ys):
+    """Returns the grayscale patches around the gates
+
+    Args:
+        img (RGB-image): resized screenshot of the smartphone window
+        xs (array): x-positions of the gates
+        ys (array): y-positions of the gates
+
+    Returns:
+        array: patches (n, 2*PATCH_RADIUS+1, 2*PATCH_RADIUS+1)
+    """
+    gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+    gray = cv2.copyMakeBorder(gray, PATCH_RADIUS, PATCH_RADIUS, PATCH_RADIUS, PATCH_RADIUS, cv2.BORDER_CONSTANT)
+    size = 2*PATCH_RADIUS+1
+    return np.array([gray[y:y+size, x:x+size] for x, y in zip(xs, ys)], dtype=np.float32).reshape(-1, size, size)
+
+
+def grid_record(mygrid, img):
+    """Returns a copy of a calibrated grid for the cache.
+    The game changes the gate states of the grid, so a grid that is saved
+    later must be copied right after the calibration.
+
+    Args:
+        mygrid (Grid): calibrated grid
+        img (RGB-image): frame the grid was calibrated on
+
+    Returns:
+        dict: file name and arrays of the cache file
+    """
+    gates = mygrid.gates
+    arrays = {name: np.copy(getattr(mygrid, name)) for name in GRID_ARRAYS}
+    values = {name: getattr(mygrid, name) for name in GRID_VALUES}
+    arrays.update(fingerprint=fingerprint(img),
+                  patches=gate_patches(img, mygrid.xs[gates], mygrid.ys[gates]),
+                  points=json.dumps(mygrid.points, default=to_json),
+                  values=json.dumps(values, default=to_json))
+    return {'name': 'grid-%d-%d-%d.npz' % (img.shape[0], img.shape[1], len(gates)), 'arrays': arrays}
+
+
+def write_grid(directory, record):
+    """Writes a grid copied by grid_record
+
+    Args:
+        directory (string): cache directory
+        record (dict): copy of the grid
+    """
+    os.makedirs(directory, exist_ok=True)
+    np.savez_compressed(os.path.join(directory, record['name']), **record['arrays'])
+
+
+def load_grid(directory, img, max_thumbnail_diff=10, max_patch_diff=25, min_matching_gates=0.8):
+    """Loads a cached grid that matches a level frame
+
+    The cached grid is only used if the thumbnail of the frame is close to
+    the cached one and most gate patches still match, so a different level
+    or a moved window leads to a full calibration. The state of a gate whose
+    patch does not match is read from the frame, if it cannot be read the
+    cached grid is not used.
+
+    Args:
+        directory (string): cache directory
+        img (RGB-image): resized screenshot of the smartphone window
+        max_thumbnail_diff (float, optional): maximal mean absolute difference of the thumbnails
+        max_patch_diff (float, optional): maximal mean absolute difference of a gate patch
+        min_matching_gates (float, optional): minimal fraction of matching gate patches
+
+    Returns:
+        Grid: cached grid, None if no cached grid matches
+    """
+    thumbnail = fingerprint(img)
+    for path in sorted(glob.glob(os.path.join(directory, 'grid-%d-%d-*.npz' % img.shape[:2]))):
+        with np.load(path) as data:
+            if np.mean(np.abs(data['fingerprint']-thumbnail)) > max_thumbnail_diff:
+                continue
+            gates = data['gates']
+            patches = gate_patches(img, data['xs'][gates], data['ys'][gates])
+            diffs = np.mean(np.abs(patches-data['patches']), axis=(1, 2))
+            if len(diffs) == 0 or np.mean(diffs <= max_patch_diff) < min_matching_gates:
+                continue
+
+            mygrid = Grid.__new__(Grid)
+            mygrid.img = img
+            mygrid.gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+            mygrid.points = json.loads(str(data['points']))
+            for name, value in json.loads(str(data['values'])).items():
+                setattr(mygrid, name, value)
+            for name in GRID_ARRAYS:
+                setattr(mygrid, name, data[name])
+        mygrid.build_routes()
+        # a gate that was switched since the grid was cached does not show its cached state,
+        # its state is read with the templates of the matching gates
+        matching = diffs <= max_patch_diff
+        mygrid.build_gate_templates(matching)
+        if not np.all(matching):
+            if not mygrid.read_gate_states(np.flatnonzero(~matching), max_patch_diff):
+                continue
+            mygrid.build_gate_templates()
+        return mygrid
+    return None
+
+
+def save_window(directory, screen):
+    """Saves the location of the smartphone window
+
+    Args:
+        directory (string): cache directory
+        screen (Screen): screen with located window
+    """
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, 'window.json'), 'w') as window_file:
+        json.dump([screen.x, screen.y, screen.width, screen.height], window_file, default=to_json)
+
+
+def load_window(directory, screen):
+    """Restores the cached location of the smartphone window if the window is still there
+
+    Args:
+        directory (string): cache directory
+        screen (Screen): screen without located window
+
+    Returns:
+        bool: True if the cached location was restored
+    """
+    path = os.path.join(directory, 'window.json')
+    if not os.path.exists(path):
+        return False
+    with open(path) as window_file:
+        screen.set_field(json.load(window_file))
+    if screen.verify_field():
+        return True
+    screen.width = 0
+    return False
@@ -0,0 +1,309 @@
+import ctypes
+import ctypes.util
+import os
+import sys
+import time
+from collections import deque
+import cv2
+import numpy as np
+
+
+class CaptureBackend():
+    """Base class of the screen capture backends.
+    Every backend returns BGR-images and keeps track of its own grab times
+    """
+    name = 'base'
+
+    def __init__(self):
+        self.grab_times = deque(maxlen=1000)
+
+    def grab(self, region=None):
+        """Captures a screenshot
+
+        Args:
+            region (tuple, optional): (x, y, width, height) of the region to capture. Entire screen if None.
+
+        Returns:
+            BGR-image: screenshot of the region
+        """
+        start_time = time.perf_counter()
+        image = self._grab(region)
+        self.grab_times.append(time.perf_counter()-start_time)
+        return image
+
+    def _grab(self, region):
+        raise NotImplementedError
+
+    def stats(self):
+        """Returns the timing of the last grabs
+
+        Returns:
+            dict: number of grabs, mean, max and last grab time in seconds
+        """
+        if len(self.grab_times) == 0:
+            return {'backend': self.name, 'count': 0, 'mean': 0, 'max': 0, 'last': 0}
+        return {
+            'backend': self.name,
+            'count': len(self.grab_times),
+            'mean': sum(self.grab_times)/len(self.grab_times),
+            'max': max(self.grab_times),
+            'last': self.grab_times[-1]
+        }
+
+    def close(self):
+        pass
+
+
+class PyAutoGuiCapture(CaptureBackend):
+    """Captures screenshots with pyautogui (portable fallback)
+    """
+    name = 'pyautogui'
+
+    def __init__(self):
+        super().__init__()
+        import pyautogui
+        self.pyautogui = pyautogui
+        self.buffer = None
+
+    def _grab(self, region):
+        if region is None:
+            image = self.pyautogui.screenshot()
+        else:
+            image = self.pyautogui.screenshot(region=tuple(region))
+        image = np.asarray(image)
+        if self.buffer is None or self.buffer.shape != image.shape:
+            self.buffer = np.empty(image.shape, dtype=np.uint8)
+        # the screenshot itself is allocated by pyautogui, the converted frame reuses the buffer
+        cv2.cvtColor(image, cv2.COLOR_RGB2BGR, dst=self.buffer)
+        return self.buffer
+
+
+class XShmSegmentInfo(ctypes.Structure):
+    _fields_ = [
+        ('shmseg', ctypes.c_ulong),
+        ('shmid', ctypes.c_int),
+        ('shmaddr', ctypes.c_void_p),
+        ('readOnly', ctypes.c_int),
+    ]
+
+
+class XImage(ctypes.Structure):
+    # only the leading fields of XImage are needed
+    _fields_ = [
+        ('width', ctypes.c_int),
+        ('height', ctypes.c_int),
+        ('xoffset', ctypes.c_int),
+        ('format', ctypes.c_int),
+        ('data', ctypes.c_void_p),
+        ('byte_order', ctypes.c_int),
+        ('bitmap_unit', ctypes.c_int),
+        ('bitmap_bit_order', ctypes.c_int),
+        ('bitmap_pad', ctypes.c_int),
+        ('depth', ctypes.c_int),
+        ('bytes_per_line', ctypes.c_int),
+        ('bits_per_pixel', ctypes.c_int),
+    ]
+
+
+IPC_PRIVATE = 0
+IPC_CREAT = 0o1000
+IPC_RMID = 0
+ZPIXMAP = 2
+ALL_PLANES = 0xffffffff
+
+
+class XShmCapture(CaptureBackend):
+    """Captures screenshots through a persistent X11 shared memory segment.
+    The X server writes directly into the segment and the pixels are converted
+    into a preallocated buffer, so no image is allocated per grab.
+    The returned image is reused by the next grab.
+    """
+    name = 'xshm'
+
+    def __init__(self, display=None):
+        super().__init__()
+        if not sys.platform.startswith('linux'):
+            raise OSError('XShm capture is only available on linux')
+        if display is None and 'DISPLAY' not in os.environ:
+            raise OSError('no X display available')
+        self.xlib = self._load('X11')
+        self.xext = self._load('Xext')
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self._set_signatures()
+
+        self.display = self.xlib.XOpenDisplay(display.encode() if display else None)
+        if not self.display:
+            raise OSError('cannot open X display')
+        if not self.xext.XShmQueryExtension(self.display):
+            self.xlib.XCloseDisplay(self.display)
+            self.display = None
+            raise OSError('X server does not support the MIT-SHM extension')
+        screen_nr = self.xlib.XDefaultScreen(self.display)
+        self.root = self.xlib.XDefaultRootWindow(self.display)
+        self.visual = self.xlib.XDefaultVisual(self.display, screen_nr)
+        self.depth = self.xlib.XDefaultDepth(self.display, screen_nr)
+        self.screen_width = self.xlib.XDisplayWidth(self.display, screen_nr)
+        self.screen_height = self.xlib.XDisplayHeight(self.display, screen_nr)
+
+        self.image = None
+        self.shminfo = None
+        self.size = None
+        self.view = None
+        self.buffer = None
+
+    @staticmethod
+    def _load(name):
+        path = ctypes.util.find_library(name)
+        if path is None:
+            raise OSError('lib'+name+' not found')
+        return ctypes.CDLL(path)
+
+    def _set_signatures(self):
+        xlib = self.xlib
+        xext = self.xext
+        libc = self.libc
+        xlib.XOpenDisplay.restype = ctypes.c_void_p
+        xlib.XOpenDisplay.argtypes = [ctypes.c_char_p]
+        xlib.XCloseDisplay.argtypes = [ctypes.c_void_p]
+        xlib.XDefaultScreen.argtypes = [ctypes.c_void_p]
+        xlib.XDefaultRootWindow.restype = ctypes.c_ulong
+        xlib.XDefaultRootWindow.argtypes = [ctypes.c_void_p]
+        xlib.XDefaultVisual.restype = ctypes.c_void_p
+        xlib.XDefaultVisual.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        xlib.XDefaultDepth.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        xlib.XDisplayWidth.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        xlib.XDisplayHeight.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        xlib.XSync.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        xlib.XDestroyImage.argtypes = [ctypes.POINTER(XImage)]
+        xext.XShmQueryExtension.argtypes = [ctypes.c_void_p]
+        xext.XShmCreateImage.restype = ctypes.POINTER(XImage)
+        xext.XShmCreateImage.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int,
+                                         ctypes.c_void_p, ctypes.POINTER(XShmSegmentInfo), ctypes.c_uint, ctypes.c_uint]
+        xext.XShmAttach.argtypes = [ctypes.c_void_p, ctypes.POINTER(XShmSegmentInfo)]
+        xext.XShmDetach.argtypes = [ctypes.c_void_p, ctypes.POINTER(XShmSegmentInfo)]
+        xext.XShmGetImage.argtypes = [ctypes.c_void_p, ctypes.c_ulong, ctypes.POINTER(XImage),
+                                      ctypes.c_int, ctypes.c_int, ctypes.c_ulong]
+        libc.shmget.restype = ctypes.c_int
+        libc.shmget.argtypes = [ctypes.c_int, ctypes.c_size_t, ctypes.c_int]
+        libc.shmat.restype = ctypes.c_void_p
+        libc.shmat.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int]
+        libc.shmdt.argtypes = [ctypes.c_void_p]
+        libc.shmctl.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p]
+
+    def _open_segment(self, width, height):
+        """Creates the shared memory image and the output buffer for a region size
+
+        Args:
+            width (int): width of the region
+            height (int): height of the region
+        """
+        self._close_segment()
+        shminfo = XShmSegmentInfo()
+        image = self.xext.XShmCreateImage(self.display, self.visual, self.depth, ZPIXMAP,
+                                          None, ctypes.byref(shminfo), width, height)
+        if not image:
+            raise OSError('XShmCreateImage failed')
+        if image.contents.bits_per_pixel != 32:
+            self.xlib.XDestroyImage(image)
+            raise OSError('unsupported pixel format: '+str(image.contents.bits_per_pixel)+' bits per pixel')
+        bytes_per_line = image.contents.bytes_per_line
+        nbytes = bytes_per_line*height
+        shminfo.shmid = self.libc.shmget(IPC_PRIVATE, nbytes, IPC_CREAT | 0o600)
+        if shminfo.shmid < 0:
+            self.xlib.XDestroyImage(image)
+            raise OSError(ctypes.get_errno(), 'shmget failed')
+        shmaddr = self.libc.shmat(shminfo.shmid, None, 0)
+        if shmaddr is None or shmaddr == ctypes.c_void_p(-1).value:
+            self.libc.shmctl(shminfo.shmid, IPC_RMID, None)
+            self.xlib.XDestroyImage(image)
+            raise OSError(ctypes.get_errno(), 'shmat failed')
+        shminfo.shmaddr = shmaddr
+        shminfo.readOnly = 0
+        image.contents.data = shmaddr
+        self.xext.XShmAttach(self.display, ctypes.byref(shminfo))
+        self.xlib.XSync(self.display, 0)
+        # the segment is freed as soon as both sides are detached
+        self.libc.shmctl(shminfo.shmid, IPC_RMID, None)
+
+        raw = np.ctypeslib.as_array((ctypes.c_ubyte*nbytes).from_address(shmaddr))
+        self.view = raw.reshape(height, bytes_per_line)[:, :width*4].reshape(height, width, 4)
+        self.buffer = np.empty((height, width, 3), dtype=np.uint8)
+        self.image = image
+        self.shminfo = shminfo
+        self.size = (width, height)
+
+    def _close_segment(self):
+        if self.image is None:
+            return
+        self.xext.XShmDetach(self.display, ctypes.byref(self.shminfo))
+        self.xlib.XSync(self.display, 0)
+        self.libc.shmdt(ctypes.c_void_p(self.shminfo.shmaddr))
+        # the data belongs to the segment, XDestroyImage must not free it
+        self.image.contents.data = None
+        self.xlib.XDestroyImage(self.image)
+        self.image = None
+        self.shminfo = None
+        self.view = None
+        self.size = None
+
+    def _grab(self, region):
+        if region is None:
+            region = (0, 0, self.screen_width, self.screen_height)
+        x, y, width, height = [int(value) for value in region]
+        if self.size != (width, height):
+            self._open_segment(width, height)
+        if not self.xext.XShmGetImage(self.display, self.root, self.image, x, y, ALL_PLANES):
+            raise OSError('XShmGetImage failed')
+        cv2.cvtColor(self.view, cv2.COLOR_BGRA2BGR, dst=self.buffer)
+        return self.buffer
+
+    def close(self):
+        if self.display is None:
+            return
+        self._close_segment()
+        self.xlib.XCloseDisplay(self.display)
+        self.display = None
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+BACKENDS = {
+    'xshm': XShmCapture,
+    'pyautogui': PyAutoGuiCapture,
+}
+
+
+def make_backend(name='auto'):
+    """Creates a capture backend
+
+    Args:
+        name (string, optional): 'xshm', 'pyautogui' or 'auto'.
+            'auto' uses xshm if it is available and falls back to pyautogui.
+
+    Returns:
+        CaptureBackend: capture backend
+    """
+    if name != 'auto':
+        return BACKENDS[name]()
+    try:
+        return XShmCapture()
+    except OSError:
+        return PyAutoGuiCapture()
+
+
+if __name__ == '__main__':
+    # compares the available backends, e.g. headless with: xvfb-run python capture.py
+    for backend_name in BACKENDS:
+        try:
+            backend = make_backend(backend_name)
+        except (OSError, ImportError) as error:
+            print(backend_name+': not available ('+str(error)+')')
+            continue
+        for _ in range(50):
+            backend.grab((0, 0, 400, 750))
+        print(backend.stats())
+        backend.close()
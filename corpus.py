@@ -0,0 +1,110 @@
+import argparse
+import json
+import os
+import cv2
+import numpy as np
+from record import FrameReader, FrameRecorder
+from runlog import to_json
+
+# green (BGR) of the level in the desktop frames, within the HSV range of the window border in screen.py
+WINDOW_GREEN = (55, 90, 48)
+
+
+class CorpusWriter():
+    """Writes a labeled frame corpus.
+    The frames are a recording of FrameRecorder, labels.ndjson holds one
+    line per frame with the frame number and the labels:
+    trains and stations with x, y and color, gates with x and y (all in the
+    750 px high image), and window [x, y, width, height] for screenshots of
+    the whole desktop. A missing key means that the frame is not labeled for it.
+    """
+
+    def __init__(self, directory):
+        """
+        Args:
+            directory (string): output directory
+        """
+        self.recorder = FrameRecorder(directory)
+        self.labels = open(os.path.join(directory, 'labels.ndjson'), 'w')
+
+    def add(self, img, labels, timestamp=0.0):
+        """Adds a labeled frame
+
+        Args:
+            img (BGR-image): frame
+            labels (dict): labels of the frame
+            timestamp (float, optional): capture time in seconds
+        """
+        self.labels.write(json.dumps(dict(labels, frame=self.recorder.frame_nr), default=to_json)+'\n')
+        self.recorder.add(img, timestamp)
+
+    def close(self):
+        self.recorder.close()
+        self.labels.close()
+
+
+def read_corpus(directory):
+    """Reads a corpus written by CorpusWriter
+
+    Args:
+        directory (string): corpus directory
+
+    Returns:
+        list: (frame, labels) of every labeled frame
+    """
+    labels = {}
+    with open(os.path.join(directory, 'labels.ndjson')) as lines:
+        for line in lines:
+            record = json.loads(line)
+            labels[record.pop('frame')] = record
+    return [(img, labels[frame_nr]) for frame_nr, _, img in FrameReader(directory) if frame_nr in labels]
+
+
+def simulate_corpus(directory, n_frames=300, every=5, n_desktops=10, seed=0, **options):
+    """Writes a corpus of simulated frames labeled with the ground truth of the simulator
+
+    Args:
+        directory (string): output directory
+        n_frames (int, optional): number of level frames
+        every (int, optional): number of simulated frames per corpus frame
+        n_desktops (int, optional): number of desktop screenshots with a window at a random position
+        seed (int, optional): seed of the simulation and the window positions
+        **options: further arguments of Simulator
+    """
+    from simulator import BACKGROUND, Simulator
+
+    simulator = Simulator(seed=seed, **options)
+    writer = CorpusWriter(directory)
+    for _ in range(n_frames):
+        for _ in range(every):
+            img = simulator.get_image()
+        writer.add(img, simulator.labels(), simulator.time)
+
+    random = np.random.default_rng(seed)
+    for _ in range(n_desktops):
+        scale = random.uniform(0.6, 1.0)
+        window = simulator.get_image()
+        window[np.all(window == BACKGROUND, axis=2)] = WINDOW_GREEN
+        window = cv2.resize(window, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        desktop = np.full((900, 1600, 3), random.integers(20, 60), np.uint8)
+        (height, width) = window.shape[:2]
+        x = int(random.integers(0, desktop.shape[1]-width))
+        y = int(random.integers(0, desktop.shape[0]-height))
+        desktop[y:y+height, x:x+width] = window
+        writer.add(desktop, {'window': [x, y, width, height]}, simulator.time)
+    writer.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Writes a labeled corpus of simulated frames for tune.py')
+    parser.add_argument('directory', help='output directory')
+    parser.add_argument('--frames', type=int, default=300, help='number of level frames')
+    parser.add_argument('--every', type=int, default=5, help='number of simulated frames per corpus frame')
+    parser.add_argument('--desktops', type=int, default=10, help='number of desktop screenshots for the window search')
+    parser.add_argument('--trains', type=int, default=8, help='maximal number of trains at the same time')
+    parser.add_argument('--speed', type=float, default=100, help='train speed in pixels per second')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    simulate_corpus(args.directory, args.frames, args.every, args.desktops, args.seed,
+                    n_trains=args.trains, speed=args.speed)
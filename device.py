@@ -0,0 +1,286 @@
+import argparse
+import shlex
+import subprocess
+import threading
+import time
+from collections import deque
+import cv2
+import numpy as np
+import instrument
+from instrument import span
+from screen import Screen
+from workspace import get_buffer
+
+# bytes per pixel of the raw frame formats
+RAW_FORMATS = {'rgb24': 3, 'bgr24': 3, 'rgba': 4}
+
+# heights of the status and navigation bar around the game in the simulated device frames
+SIMULATED_BARS = (48, 72)
+
+
+class DeviceScreen():
+    """Frame source that reads the screen stream of the device directly, without desktop mirroring.
+    The stream is either raw frames back to back (e.g. 'adb exec-out screenrecord
+    --output-format=raw-frames -' or ffmpeg with -f rawvideo) or a video stream
+    that OpenCV can decode (e.g. an H.264 file or a tcp:// URL). A background
+    thread decodes every frame into one of three preallocated buffers, get_image
+    returns the newest one. The green play field is searched on the first
+    frame like the window on the desktop (see Screen.find_field_rect), x, y
+    and scale map the game image to frame pixels (see actuate.ShellTapActuator).
+    """
+
+    def __init__(self, source, size=None, pixel_format='rgb24', fps=None, loop=False, timeout=2.0, coarse_factor=8):
+        """
+        Args:
+            source (string or list): path of a file or pipe, '-' for stdin, a URL for video streams,
+                or a command (list) that writes the stream to its stdout
+            size (tuple, optional): width and height of the raw frames, read from the stream for video
+            pixel_format (string, optional): 'rgb24', 'bgr24' or 'rgba' for raw frames, 'video' for a video stream
+            fps (float, optional): frames per second to read a file with, None to read as fast as possible
+            loop (bool, optional): start the stream again at its end, for files that stand in for the device
+            timeout (float, optional): maximal waiting time in seconds for a new frame
+            coarse_factor (int, optional): subsampling of the frame for the coarse field search
+        """
+        self.source = source
+        self.pixel_format = pixel_format
+        self.fps = fps
+        self.loop = loop
+        self.timeout = timeout
+        self.process = None
+        self.stream = None
+        self.video = None
+        self.stop = threading.Event()
+        self.open()
+        if pixel_format == 'video':
+            size = (int(self.video.get(cv2.CAP_PROP_FRAME_WIDTH)), int(self.video.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+        if size is None or size[0] <= 0 or size[1] <= 0:
+            self._close()
+            raise ValueError('unknown frame size of '+str(source))
+
+        self.frame_size = tuple(size)
+        self.coarse_factor = coarse_factor
+        # Screen interface, set by find_field
+        self.x = 0
+        self.y = 0
+        self.width = 0
+        self.height = 0
+        self.scale = 1
+        self.new_width = 0
+        self.new_height = 0
+
+        (width, height) = self.frame_size
+        channels = RAW_FORMATS.get(pixel_format, 3)
+        self.raw = np.empty((height, width, channels), dtype=np.uint8)
+        self.buffers = [np.empty((height, width, 3), dtype=np.uint8) for _ in range(3)]
+        self.condition = threading.Condition()
+        self.latest = None
+        self.in_use = None
+        self.n_frames = 0
+        self.n_read = 0
+        self.ended = False
+        self.decode_times = deque(maxlen=1000)
+        self.thread = threading.Thread(target=self._read, daemon=True)
+        self.thread.start()
+
+    def open(self):
+        """Opens the stream
+        """
+        if self.pixel_format == 'video':
+            self.video = cv2.VideoCapture(self.source)
+            if not self.video.isOpened():
+                raise OSError('cannot open video stream '+str(self.source))
+        elif isinstance(self.source, (list, tuple)):
+            self.process = subprocess.Popen(list(self.source), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            self.stream = self.process.stdout
+        elif self.source == '-':
+            self.stream = open(0, 'rb', buffering=0, closefd=False)
+        else:
+            self.stream = open(self.source, 'rb', buffering=0)
+
+    def _decode(self, buffer):
+        """Decodes the next frame of the stream into a buffer
+
+        Args:
+            buffer (array): BGR buffer of the frame
+
+        Returns:
+            bool: False at the end of the stream
+        """
+        if self.video is not None:
+            ok, image = self.video.read(buffer)
+            if ok and image is not buffer:
+                np.copyto(buffer, image)
+            return ok
+        view = memoryview(self.raw).cast('B')
+        filled = 0
+        while filled < len(view):
+            n_bytes = self.stream.readinto(view[filled:])
+            if not n_bytes:
+                return False
+            filled += n_bytes
+        if self.pixel_format == 'rgb24':
+            cv2.cvtColor(self.raw, cv2.COLOR_RGB2BGR, dst=buffer)
+        elif self.pixel_format == 'rgba':
+            cv2.cvtColor(self.raw, cv2.COLOR_RGBA2BGR, dst=buffer)
+        else:
+            np.copyto(buffer, self.raw)
+        return True
+
+    def _read(self):
+        back = 0
+        next_time = time.perf_counter()
+        while not self.stop.is_set():
+            start_time = time.perf_counter()
+            if not self._decode(self.buffers[back]):
+                if self.loop and not self.stop.is_set() and (self.video is not None or self.process is None):
+                    self._close()
+                    self.open()
+                    continue
+                with self.condition:
+                    self.ended = True
+                    self.condition.notify_all()
+                return
+            self.decode_times.append(time.perf_counter()-start_time)
+            with self.condition:
+                self.latest = back
+                self.n_read += 1
+                self.condition.notify_all()
+                # the third buffer is neither the newest frame nor the frame that get_image resizes
+                back = next(idx for idx in range(3) if idx != self.latest and idx != self.in_use)
+            if self.fps is not None:
+                next_time += 1/self.fps
+                time.sleep(max(next_time-time.perf_counter(), 0))
+
+    def find_field(self, image):
+        """Finds the play field in a frame of the device
+
+        Args:
+            image (BGR-image): frame of the device
+        """
+        rect = Screen.find_field_rect(image, self.coarse_factor)
+        if rect is None or rect[3] == 0:
+            return
+        self.x, self.y, self.width, self.height = rect
+        self.scale = self.height/750
+        self.new_width = int(self.width/self.scale)
+        self.new_height = int(self.height/self.scale)
+
+    def get_image(self, proc_scale=1.0, workspace=None):
+        """Returns the play field of the newest frame of the device, see Screen.get_image.
+        Waits for a frame that was not returned before, and until the play field is found.
+
+        Args:
+            proc_scale (float, optional): resolution relative to the full (750 px high) image
+            workspace (Workspace, optional): workspace of the frame buffer
+
+        Returns:
+            BGR-image: resized play field
+        """
+        searched = False
+        while True:
+            with self.condition:
+                if not self.condition.wait_for(lambda: self.n_read > self.n_frames or self.ended, self.timeout):
+                    raise OSError('no frame from the device for %.1f s' % self.timeout)
+                if self.n_read == self.n_frames:
+                    raise EOFError('device stream has ended')
+                self.n_frames = self.n_read
+                self.in_use = self.latest
+            try:
+                frame = self.buffers[self.in_use]
+                if self.width == 0:
+                    with span('screen.find_field'):
+                        self.find_field(frame)
+                if self.width > 0:
+                    with span('screen.resize'):
+                        size = (int(self.new_width*proc_scale), int(self.new_height*proc_scale))
+                        return cv2.resize(frame[self.y:self.y+self.height, self.x:self.x+self.width], size,
+                                          dst=get_buffer(workspace, 'frame', (size[1], size[0], 3)))
+            finally:
+                with self.condition:
+                    self.in_use = None
+            if not searched:
+                print('no app screen found')
+                searched = True
+
+    def stats(self):
+        """Returns the decoding statistics
+
+        Returns:
+            dict: number of decoded and returned frames, mean and max decoding time in seconds
+        """
+        decode_times = list(self.decode_times) or [0]
+        return {'decoded': self.n_read, 'returned': self.n_frames,
+                'mean': sum(decode_times)/len(decode_times), 'max': max(decode_times)}
+
+    def close(self):
+        """Stops the decoding thread and closes the stream
+        """
+        self.stop.set()
+        if self.process is not None:
+            # unblocks the decoding thread
+            self.process.kill()
+        self.thread.join(self.timeout)
+        self._close()
+
+    def _close(self):
+        if self.video is not None:
+            self.video.release()
+            self.video = None
+        if self.process is not None:
+            self.process.kill()
+            self.process.wait()
+            self.process = None
+        elif self.stream is not None:
+            self.stream.close()
+        self.stream = None
+
+
+def write_raw(path, n_frames=300, **options):
+    """Writes simulated frames as a raw rgb24 stream that stands in for the device.
+    The level is shown with a green play field between a status and a navigation bar.
+
+    Args:
+        path (string): output file or pipe
+        n_frames (int, optional): number of frames
+        **options: further arguments of Simulator
+    """
+    from corpus import WINDOW_GREEN
+    from simulator import BACKGROUND, Simulator
+
+    simulator = Simulator(**options)
+    top, bottom = SIMULATED_BARS
+    with open(path, 'wb') as stream:
+        for _ in range(n_frames):
+            img = simulator.get_image()
+            img[np.all(img == BACKGROUND, axis=2)] = WINDOW_GREEN
+            frame = cv2.copyMakeBorder(img, top, bottom, 0, 0, cv2.BORDER_CONSTANT, value=(0, 0, 0))
+            stream.write(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB).tobytes())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Reads a device screen stream and reports the frame rate, '
+                                                 'or writes a simulated raw stream that stands in for the device')
+    parser.add_argument('source', help='file, pipe or URL of the stream, output file with --write')
+    parser.add_argument('--command', action='store_true', help='source is a command that writes the stream to its stdout')
+    parser.add_argument('--size', default='422x870', help='width x height of raw frames, 422x870 for simulated frames')
+    parser.add_argument('--format', default='rgb24', choices=list(RAW_FORMATS)+['video'], help='pixel format of raw frames or video')
+    parser.add_argument('--fps', type=float, help='frames per second to read a file with')
+    parser.add_argument('--frames', type=int, default=300, help='number of frames to read or write')
+    parser.add_argument('--write', action='store_true', help='write a simulated raw rgb24 stream to source')
+    args = parser.parse_args()
+
+    if args.write:
+        write_raw(args.source, args.frames)
+    else:
+        source = shlex.split(args.source) if args.command else args.source
+        screen = DeviceScreen(source, tuple(int(value) for value in args.size.split('x')), args.format, args.fps, loop=True)
+        instrument.enable()
+        start_time = time.perf_counter()
+        for _ in range(args.frames):
+            screen.get_image()
+        wall_time = time.perf_counter()-start_time
+        stats = screen.stats()
+        screen.close()
+        print('frames: %d  fps: %.1f  decoded: %d  decode [ms]: mean %.2f max %.2f' % (
+            args.frames, args.frames/wall_time, stats['decoded'], stats['mean']*1000, stats['max']*1000))
+        instrument.summary()
@@ -0,0 +1,153 @@
+import cv2
+import numpy as np
+from grid import TEMPLATE_RADIUS
+from workspace import Workspace
+
+
+class GateReader():
+    """Reads the state of every gate from the frame.
+    The patch of every gate is compared with the templates of its two states
+    (see Grid.build_gate_templates). A confident match that differs from the
+    believed state corrects mygrid.ostate, so a lost click is repeated by the
+    planner instead of toggling the gate blindly. Gates with a train nearby
+    and gates that were clicked a moment ago are not read.
+    """
+
+    def __init__(self, mygrid, max_diff=15, min_margin=0.6, train_distance=40, settle_time=0.2, workspace=None):
+        """
+        Args:
+            mygrid (Grid): calibrated grid with gate templates
+            max_diff (float, optional): maximal mean absolute gray value difference of a matching template
+            min_margin (float, optional): maximal ratio of the differences of the matching and the other template
+            train_distance (int, optional): gates with a train closer than this (pixels) are not read
+            settle_time (float, optional): seconds after a click until the gate is read again
+            workspace (Workspace, optional): buffers of the patches, a new workspace if None
+        """
+        self.mygrid = mygrid
+        self.max_diff = max_diff
+        self.min_margin = min_margin
+        self.train_distance = train_distance
+        self.settle_time = settle_time
+        self.gates = mygrid.gates
+        self.workspace = workspace if workspace is not None else Workspace()
+        self.clicks = np.full(len(self.gates), -np.inf)
+        self.levels = {}
+        self.n_reads = 0
+        self.n_corrections = 0
+        self.n_learned = 0
+
+    def get_level(self, shape):
+        """Returns the gate patches and the templates at the resolution of a frame
+
+        Args:
+            shape (tuple): shape of the frame
+
+        Returns:
+            list: slices of the gate patches
+            array: templates (n_gates, 2, size, size)
+        """
+        level = self.levels.get(shape[:2])
+        if level is None:
+            (height, width) = shape[:2]
+            factor = height/self.mygrid.gray.shape[0]
+            radius = max(int(TEMPLATE_RADIUS*factor), 1)
+            size = 2*radius+1
+            # patches at the border are shifted into the frame
+            tops = np.clip((self.mygrid.ys[self.gates]*factor).astype(int)-radius, 0, height-size)
+            lefts = np.clip((self.mygrid.xs[self.gates]*factor).astype(int)-radius, 0, width-size)
+            patches = [(slice(top, top+size), slice(left, left+size)) for top, left in zip(tops, lefts)]
+            templates = self.mygrid.gate_templates
+            if size != templates.shape[-1]:
+                templates = np.array([[cv2.resize(template, (size, size), interpolation=cv2.INTER_AREA) for template in pair]
+                                      for pair in templates]).reshape(len(self.gates), 2, size, size)
+            level = (patches, templates)
+            self.levels[shape[:2]] = level
+        return level
+
+    def update(self, img, trains, timestamp):
+        """Reads the gate states of a frame and corrects mygrid.ostate
+
+        Args:
+            img (RGB-image): screenshot of the game at proc_scale
+            trains (list): trains of the frame, positions in the full image
+            timestamp (float): capture time in seconds
+
+        Returns:
+            list: grid numbers of the gates whose state was corrected
+        """
+        if len(self.gates) == 0:
+            return []
+        readable = timestamp-self.clicks >= self.settle_time
+        xs = self.mygrid.xs[self.gates]
+        ys = self.mygrid.ys[self.gates]
+        for train in trains:
+            readable &= (xs-train['x'])**2+(ys-train['y'])**2 >= self.train_distance**2
+        if not np.any(readable):
+            return []
+
+        slices, templates = self.get_level(img.shape)
+        index = np.flatnonzero(readable)
+        size = templates.shape[-1]
+        n_gates = len(self.gates)
+        n_read = len(index)
+        # all patches in one color conversion, the buffers fit all gates and are used up to n_read
+        color = self.workspace.get('gate_color', (n_gates*size, size, 3))[:n_read*size]
+        np.concatenate([img[slices[idx]] for idx in index], out=color)
+        gray = self.workspace.get('gate_gray', (n_gates*size, size))[:n_read*size]
+        cv2.cvtColor(color, cv2.COLOR_RGB2GRAY, dst=gray)
+        patches = self.workspace.get('gate_patches', (n_gates, size, size), np.float32)[:n_read]
+        np.copyto(patches, gray.reshape(-1, size, size))
+        differences = self.workspace.get('gate_differences', (n_gates, 2, size, size), np.float32)[:n_read]
+        np.take(templates, index, axis=0, out=differences, mode='clip')
+        np.subtract(differences, patches[:, None], out=differences)
+        np.abs(differences, out=differences)
+        diffs = np.mean(differences, axis=(2, 3))
+        known = self.mygrid.template_known[index]
+        diffs[~known] = np.inf
+        self.n_reads += len(index)
+
+        corrected = []
+        for idx, diff, patch, pair in zip(index, diffs, patches, known):
+            gate = self.gates[idx]
+            k = int(np.argmin(diff))
+            if diff[k] < self.max_diff and diff[k] < self.min_margin*diff[1-k]:
+                state = self.mygrid.adjacency[gate, k]
+            elif (np.sum(pair) == 1 and diff[k] >= self.max_diff and self.clicks[idx] > -np.inf
+                  and self.mygrid.ostate[gate] == self.mygrid.adjacency[gate, 1-k]):
+                # the gate was clicked into the state that the calibration frame did not show
+                state = self.learn(idx, 1-k, patch)
+            else:
+                continue
+            if self.mygrid.ostate[gate] != state:
+                self.mygrid.ostate[gate] = state
+                self.n_corrections += 1
+                corrected.append(gate)
+        return corrected
+
+    def learn(self, idx, k, patch):
+        """Adds the template of a gate state that was not shown in the calibration frame
+
+        Args:
+            idx (int): index of the gate in mygrid.gates
+            k (int): index of the state in the adjacency of the gate
+            patch (array): gray patch of the gate in that state
+
+        Returns:
+            int: grid number of the state
+        """
+        size = self.mygrid.gate_templates.shape[-1]
+        self.mygrid.gate_templates[idx, k] = cv2.resize(patch, (size, size), interpolation=cv2.INTER_LINEAR)
+        self.mygrid.template_known[idx, k] = True
+        self.levels = {}
+        self.n_learned += 1
+        return self.mygrid.adjacency[self.gates[idx], k]
+
+    def clicked(self, gates, timestamp):
+        """Notes the clicks on gates, their patches change until the gates have settled
+
+        Args:
+            gates (list): grid numbers of the clicked gates
+            timestamp (float): time of the clicks in seconds
+        """
+        for gate in gates:
+            self.clicks[np.flatnonzero(self.gates == gate)] = timestamp
@@ -1,16 +1,50 @@
 import numpy as np
 import cv2
+from instrument import span
 from util import find_items
 
+TYPE_STATION = 0
+TYPE_GATE = 1
+TYPE_TRACK = 2
+TYPE_CODES = {'station': TYPE_STATION, 'gate': TYPE_GATE, 'track': TYPE_TRACK}
+
+# value of the cell lookup image for pixels outside the grid
+CELL_ERROR = -2
+
+# direction of travel (x, y) into a cell for every incoming side [top, bottom, left, right, none]
+INCOMING_DIRECTIONS = np.array([[0, 1], [0, -1], [1, 0], [-1, 0], [0, 0]])
+
+# track length in pixels from the entry of a cell to its center
+ENTRY_LENGTH = 30
+
+# HoughCircles parameters of the gates: Canny threshold, accumulator threshold and radius range, see tune.py
+GATE_CANNY = 50
+GATE_VOTES = 40
+GATE_RADII = (22, 35)
+
+# half size in pixels of the gate templates, inside the gate circle
+TEMPLATE_RADIUS = 20
+
+# position of the sides [top, bottom, left, right] in counterclockwise order, see np.rot90
+SIDE_QUARTERS = [0, 2, 1, 3]
+
 class Grid:
+    """Track graph of the level.
+    self.points describes the cells as found during construction. The runtime
+    model is kept in arrays indexed by grid number (types, xs, ys, adjacency,
+    state, ostate, distance, incoming), cell_map maps every pixel to its grid number
+    and distance_map to its distance along the track from start.
+    """
     def __init__(self, img):
         self.grid = np.ones((7,5), dtype=np.uint8)*-1
         self.img = img
         self.gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
 
-        stations, self.n_stations = find_items(img, stations=True)
+        with span('grid.stations'):
+            stations, self.n_stations = find_items(img, stations=True)
 
-        gates = self.find_gates(img)
+        with span('grid.gates'):
+            gates = self.find_gates(img)
         self.points = stations + gates
 
         (height, width) = self.gray.shape
@@ -45,9 +79,17 @@ class Grid:
                 self.grid[y, x] = int(idx)
                 point['grid_nr'] = idx
 
-        start = self.find_start()
-        self.align_grid_positions()
-        self.find_directions(len(self.points)-1, start, 2)
+        with span('grid.directions'):
+            start = self.find_start()
+            self.align_grid_positions()
+            self.find_directions(len(self.points)-1, start, 2)
+        with span('grid.routes'):
+            self.build_arrays()
+            self.build_cell_map()
+            self.build_distance_map()
+            self.build_routes()
+        with span('grid.templates'):
+            self.build_gate_templates()
 
 
     def get_grid_position(self, point):
@@ -94,6 +136,193 @@ class Grid:
                     self.points[idx]['x'] = round(np.mean(mean_x))
 
 
+    def build_arrays(self):
+        """Builds the array representation of the track graph from self.points
+        """
+        n_points = len(self.points)
+        self.types = np.array([TYPE_CODES[point['type']] for point in self.points], dtype=np.int8)
+        self.xs = np.array([point.get('x', -1) for point in self.points], dtype=np.int32)
+        self.ys = np.array([point.get('y', -1) for point in self.points], dtype=np.int32)
+        self.adjacency = np.full((n_points, 2), -1, dtype=np.int32)
+        self.state = np.full(n_points, -1, dtype=np.int32)
+        self.ostate = np.full(n_points, -1, dtype=np.int32)
+        self.distance = np.full(n_points, np.nan)
+        self.incoming = np.full(n_points, -1, dtype=np.int8)
+        for idx, point in enumerate(self.points):
+            for k, direction in enumerate(point.get('directions', [])[:2]):
+                self.adjacency[idx, k] = direction
+            self.state[idx] = point.get('state', -1)
+            self.ostate[idx] = point.get('ostate', -1)
+            self.distance[idx] = point.get('distance', np.nan)
+            self.incoming[idx] = point.get('incoming', -1)
+        self.gates = np.flatnonzero(self.types == TYPE_GATE)
+
+    def build_cell_map(self):
+        """Builds the lookup image that maps every pixel of the frame to its grid number.
+        Pixels outside the grid are CELL_ERROR.
+        """
+        (height, width) = self.gray.shape
+        (n_rows, n_cols) = self.grid.shape
+        cols = (np.arange(width)-int(self.min_x))//int(self.gridsize_x)
+        rows = (np.arange(height)-int(self.min_y))//int(self.gridsize_y)
+        # negative positions wrap around like the indexing of self.grid
+        valid_cols = (cols >= -n_cols) & (cols < n_cols)
+        valid_rows = (rows >= -n_rows) & (rows < n_rows)
+        self.cell_map = self.grid[(rows % n_rows)[:, None], (cols % n_cols)[None, :]].astype(np.int16)
+        self.cell_map[~valid_rows, :] = CELL_ERROR
+        self.cell_map[:, ~valid_cols] = CELL_ERROR
+
+    def build_distance_map(self):
+        """Builds the lookup image of the distance from start for every pixel.
+        The distance of a pixel is the distance of its cell plus the track
+        length from the entry of the cell to the pixel (in units of 100 px).
+        The track enters the cell from the incoming side and leaves towards
+        one of the directions; every pixel is projected onto the closest of
+        these legs.
+        """
+        (height, width) = self.cell_map.shape
+        n_points = len(self.points)
+        cells = self.cell_map.astype(np.intp) % n_points
+
+        # direction of the legs of every cell: back to the entry and to both directions
+        legs = np.zeros((n_points, 3, 2))
+        legs[:, 0] = -INCOMING_DIRECTIONS[self.incoming]
+        for k in range(2):
+            neighbors = self.adjacency[:, k]
+            has_leg = (neighbors >= 0) & (self.xs >= 0) & (self.xs[neighbors] >= 0)
+            legs[has_leg, k+1, 0] = np.sign(self.xs[neighbors[has_leg]]-self.xs[has_leg])
+            legs[has_leg, k+1, 1] = np.sign(self.ys[neighbors[has_leg]]-self.ys[has_leg])
+
+        x_rel = (np.arange(width)[None, :]-self.xs[cells]).astype(np.float32)
+        y_rel = (np.arange(height)[:, None]-self.ys[cells]).astype(np.float32)
+        cell_legs = legs[cells]
+        projections = x_rel[..., None]*cell_legs[..., 0]+y_rel[..., None]*cell_legs[..., 1]
+        leg = np.argmax(projections, axis=2)
+        projection = np.take_along_axis(projections, leg[..., None], axis=2)[..., 0]
+        track_length = np.where(leg == 0, ENTRY_LENGTH-projection, ENTRY_LENGTH+projection)
+        track_length = np.maximum(track_length, 0)
+
+        distance_map = self.distance[cells]+np.where(self.xs[cells] >= 0, track_length/100, 0)
+        distance_map[np.isnan(distance_map) | (self.cell_map == CELL_ERROR)] = 0
+        self.distance_map = distance_map.astype(np.float32)
+
+    def exit_quarter(self, gate, neighbor):
+        """Returns the side of a gate towards a neighbor in counterclockwise quarters from the top
+        """
+        d_x = self.xs[neighbor]-self.xs[gate]
+        d_y = self.ys[neighbor]-self.ys[gate]
+        if abs(d_y) > abs(d_x):
+            return SIDE_QUARTERS[0] if d_y < 0 else SIDE_QUARTERS[1]
+        return SIDE_QUARTERS[2] if d_x < 0 else SIDE_QUARTERS[3]
+
+    def build_gate_templates(self, shown=None):
+        """Builds a grayscale template of both states of every gate.
+        The calibration frame shows one state of every gate. Turned so that
+        the train enters from the top, a gate shows either a straight piece or
+        a curve to the right (curves to the left are mirrored), so a state that
+        is not shown by a gate is taken from another gate that shows it.
+        self.gate_templates[gate, k] is the template for state adjacency[gate, k],
+        self.template_known[gate, k] is False if no gate showed that state.
+
+        Args:
+            shown (array, optional): True for the gates in self.gates whose state
+                self.state shows in the image, all gates if None
+        """
+        size = 2*TEMPLATE_RADIUS+1
+        n_gates = len(self.gates)
+        self.gate_templates = np.zeros((n_gates, 2, size, size), dtype=np.float32)
+        self.template_known = np.zeros((n_gates, 2), dtype=bool)
+        gray = cv2.copyMakeBorder(self.gray, TEMPLATE_RADIUS, TEMPLATE_RADIUS, TEMPLATE_RADIUS, TEMPLATE_RADIUS, cv2.BORDER_REPLICATE)
+
+        # canonical templates (incoming side at the top) of straight pieces and right curves
+        canonical = {}
+        transforms = []
+        for idx, gate in enumerate(self.gates):
+            turns = (-SIDE_QUARTERS[self.incoming[gate]]) % 4 if 0 <= self.incoming[gate] < 4 else None
+            shapes = []
+            for neighbor in self.adjacency[gate]:
+                if turns is None or neighbor < 0:
+                    shapes.append(None)
+                    continue
+                side = (self.exit_quarter(gate, neighbor)+turns) % 4
+                shapes.append('straight' if side == 2 else 'curve')
+            transforms.append((turns, shapes))
+            if shapes[0] is None or shapes[1] is None or self.state[gate] not in self.adjacency[gate]:
+                continue
+            if shown is not None and not shown[idx]:
+                continue
+            k = list(self.adjacency[gate]).index(self.state[gate])
+            x = self.xs[gate]
+            y = self.ys[gate]
+            patch = np.rot90(gray[y:y+size, x:x+size].astype(np.float32), turns)
+            if (self.exit_quarter(gate, self.adjacency[gate, k])+turns) % 4 == 1:
+                patch = np.fliplr(patch)
+            canonical.setdefault(shapes[k], []).append(patch)
+        canonical = {shape: np.mean(patches, axis=0) for shape, patches in canonical.items()}
+
+        for idx, gate in enumerate(self.gates):
+            turns, shapes = transforms[idx]
+            for k in range(2):
+                if shapes[k] not in canonical:
+                    continue
+                template = canonical[shapes[k]]
+                if (self.exit_quarter(gate, self.adjacency[gate, k])+turns) % 4 == 1:
+                    template = np.fliplr(template)
+                self.gate_templates[idx, k] = np.rot90(template, -turns)
+                self.template_known[idx, k] = True
+
+    def read_gate_states(self, indices, max_diff=25):
+        """Reads the state of gates from the image with the gate templates
+        and sets state and ostate
+
+        Args:
+            indices (array): indices of the gates in self.gates
+            max_diff (float, optional): maximal mean absolute difference of the matching template
+
+        Returns:
+            bool: False if the state of a gate cannot be read
+        """
+        size = 2*TEMPLATE_RADIUS+1
+        gray = cv2.copyMakeBorder(self.gray, TEMPLATE_RADIUS, TEMPLATE_RADIUS, TEMPLATE_RADIUS, TEMPLATE_RADIUS, cv2.BORDER_REPLICATE)
+        for idx in indices:
+            if not np.all(self.template_known[idx]):
+                return False
+            gate = self.gates[idx]
+            x = self.xs[gate]
+            y = self.ys[gate]
+            patch = gray[y:y+size, x:x+size].astype(np.float32)
+            diffs = np.mean(np.abs(self.gate_templates[idx]-patch), axis=(1, 2))
+            k = int(np.argmin(diffs))
+            if diffs[k] > max_diff or diffs[k] >= diffs[1-k]:
+                return False
+            self.state[gate] = self.adjacency[gate, k]
+            self.ostate[gate] = self.adjacency[gate, k]
+        return True
+
+    def get_grid_nrs(self, xs, ys):
+        """Get the grid numbers of several trains
+
+        Args:
+            xs (array): x-positions
+            ys (array): y-positions
+
+        Returns:
+            array: grid numbers, CELL_ERROR for positions outside the grid
+        """
+        return self.cell_map[ys, xs]
+
+    def get_distances(self, xs, ys):
+        """Get the distances of several trains from start
+
+        Args:
+            xs (array): x-positions
+            ys (array): y-positions
+
+        Returns:
+            array: distances along the track between trains and start
+        """
+        return self.distance_map[ys, xs]
+
     def get_grid_nr(self, train):
         """Get the grid number of a train
 
@@ -103,10 +332,10 @@ class Grid:
         Returns:
             int: grid number
         """
-        x, y = self.get_grid_position(train)
-        if x >= self.grid.shape[1] or y >= self.grid.shape[0]:
+        grid_nr = self.cell_map[train['y'], train['x']]
+        if grid_nr == CELL_ERROR:
             return 'error'
-        return self.grid[y, x]
+        return grid_nr
 
     def get_distance(self, train):
         """Caculates the distance of a train from start
@@ -117,23 +346,7 @@ class Grid:
         Returns:
             float: distance between train and start
         """
-        grid_nr = self.get_grid_nr(train)
-        if grid_nr == 'error' or 'distance' not in self.points[grid_nr]:
-            return 0
-        dist = self.points[grid_nr]['distance']
-        if 'x' in self.points[grid_nr]:
-            x_dist = train['x']-self.points[grid_nr]['x']
-            y_dist = train['y']-self.points[grid_nr]['y']
-            if self.points[grid_nr]['incoming'] == 0: # top
-                y_dist += 30
-            elif self.points[grid_nr]['incoming'] == 1: # bottom
-                y_dist -= 30
-            elif self.points[grid_nr]['incoming'] == 2: # left
-                x_dist += 30
-            elif self.points[grid_nr]['incoming'] == 3: # right
-                x_dist -= 30
-            dist += np.sqrt(np.power(x_dist, 2)+np.power(y_dist, 2))/100
-        return dist
+        return self.distance_map[train['y'], train['x']]
 
     def find_start(self):
         """Find the start point (point of first gate)
@@ -246,7 +459,57 @@ class Grid:
                 self.find_directions(gate_nr, direction, distance)
 
 
-    def find_gates(self, img):
+    def build_routes(self):
+        """Builds the routing table from every cell to every station
+
+        The track graph is fixed after find_directions, so the route of a
+        train only depends on its cell and its color. self.routes[cell][color]
+        is the list of (cell, state) pairs that have to be set to send a train
+        from cell to the station of that color.
+        """
+        self.stations = {}
+        for idx, point in enumerate(self.points):
+            if point['type'] == 'station':
+                self.stations[point['color']] = idx
+
+        self.routes = []
+        for cell, point in enumerate(self.points):
+            routes = {}
+            if point['type'] != 'station':
+                parents = {cell: None}
+                queue = [cell]
+                for current in queue:
+                    for direction in self.points[current]['directions']:
+                        if direction in parents:
+                            continue
+                        parents[direction] = current
+                        if self.points[direction]['type'] != 'station':
+                            queue.append(direction)
+                for color, goal in self.stations.items():
+                    if goal not in parents:
+                        continue
+                    route = []
+                    step = goal
+                    while parents[step] is not None:
+                        route.append((parents[step], step))
+                        step = parents[step]
+                    routes[color] = route[::-1]
+            self.routes.append(routes)
+
+    def get_route(self, cell, color):
+        """Get the gate-setting sequence from a cell to a station
+
+        Args:
+            cell (int): grid number of the train
+            color (string): color of the train
+
+        Returns:
+            list: list of (grid number, state) pairs, None if no route exists
+        """
+        return self.routes[cell].get(color)
+
+    @staticmethod
+    def find_gates(img):
         """Find all gates in an image
 
         Args:
@@ -258,7 +521,7 @@ class Grid:
         gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
         gates = []
         gray_blurred = cv2.blur(gray, (3, 3))
-        detected_circles = cv2.HoughCircles(gray_blurred, cv2.HOUGH_GRADIENT, 1, 50, param1 = 50, param2 = 40, minRadius = 22, maxRadius = 35)
+        detected_circles = cv2.HoughCircles(gray_blurred, cv2.HOUGH_GRADIENT, 1, 50, param1 = GATE_CANNY, param2 = GATE_VOTES, minRadius = GATE_RADII[0], maxRadius = GATE_RADII[1])
         if detected_circles is not None:
             detected_circles = np.around(detected_circles).astype(np.uint16)
             for point in detected_circles[0, :]:
@@ -0,0 +1,217 @@
+import math
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+_enabled = False
+_histograms = {}
+
+
+class Histogram():
+    """Streaming latency histogram with logarithmic buckets.
+    Percentiles are accurate to the bucket ratio (5% by default).
+    """
+
+    def __init__(self, min_value=1e-6, max_value=100, ratio=1.05):
+        self.min_value = min_value
+        self.ratio = ratio
+        self.scale = 1/math.log(ratio)
+        self.counts = [0]*(int(math.ceil(math.log(max_value/min_value)*self.scale))+1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        """Adds a value
+
+        Args:
+            value (float): duration in seconds
+        """
+        if value <= self.min_value:
+            idx = 0
+        else:
+            idx = min(int(math.log(value/self.min_value)*self.scale), len(self.counts)-1)
+        self.counts[idx] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, percent):
+        """Returns a percentile
+
+        Args:
+            percent (float): percentile between 0 and 100
+
+        Returns:
+            float: value in seconds
+        """
+        if self.count == 0:
+            return 0.0
+        target = percent/100*self.count
+        cumulative = 0
+        for idx, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= target and count > 0:
+                return min(self.min_value*self.ratio**(idx+0.5), self.max)
+        return self.max
+
+
+class Span():
+    """Times a with-block into a histogram
+    """
+    __slots__ = ['histogram', 'start']
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.add(time.perf_counter()-self.start)
+
+
+class NullSpan():
+    """Span used while instrumentation is off
+    """
+    __slots__ = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def enabled():
+    return _enabled
+
+
+def get_histogram(name):
+    histogram = _histograms.get(name)
+    if histogram is None:
+        histogram = _histograms.setdefault(name, Histogram())
+    return histogram
+
+
+def span(name):
+    """Returns a context manager that times a stage
+
+    Args:
+        name (string): name of the stage
+
+    Returns:
+        Span: timing span, a shared no-op span if instrumentation is off
+    """
+    if not _enabled:
+        return NULL_SPAN
+    return Span(get_histogram(name))
+
+
+def record(name, value):
+    """Adds a duration that was measured elsewhere
+
+    Args:
+        name (string): name of the stage
+        value (float): duration in seconds
+    """
+    if _enabled:
+        get_histogram(name).add(value)
+
+
+def reset():
+    _histograms.clear()
+
+
+def summary():
+    """Prints count, mean, p50, p95, p99 and max of every stage
+    """
+    if len(_histograms) == 0:
+        return
+    print('%-24s %7s %8s %8s %8s %8s %8s  [ms]' % ('stage', 'count', 'mean', 'p50', 'p95', 'p99', 'max'))
+    for name in sorted(_histograms):
+        histogram = _histograms[name]
+        if histogram.count == 0:
+            continue
+        print('%-24s %7d %8.2f %8.2f %8.2f %8.2f %8.2f' % (
+            name, histogram.count, histogram.total/histogram.count*1000, histogram.percentile(50)*1000,
+            histogram.percentile(95)*1000, histogram.percentile(99)*1000, histogram.max*1000))
+
+
+class SamplingProfiler():
+    """Samples the stack of a thread in regular intervals
+    """
+
+    def __init__(self, interval=0.005, thread_id=None):
+        """
+        Args:
+            interval (float, optional): sampling interval in seconds
+            thread_id (int, optional): thread to sample, the calling thread if None
+        """
+        self.interval = interval
+        self.thread_id = threading.get_ident() if thread_id is None else thread_id
+        self.own = Counter()
+        self.inclusive = Counter()
+        self.samples = 0
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._sample, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+
+    def _sample(self):
+        while self.running:
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.samples += 1
+                code = frame.f_code
+                self.own[(os.path.basename(code.co_filename), code.co_name, frame.f_lineno)] += 1
+                seen = set()
+                while frame is not None:
+                    code = frame.f_code
+                    key = (os.path.basename(code.co_filename), code.co_name)
+                    if key not in seen:
+                        seen.add(key)
+                        self.inclusive[key] += 1
+                    frame = frame.f_back
+            time.sleep(self.interval)
+
+    def report(self, top=15):
+        """Prints the functions and lines with the most samples
+
+        Args:
+            top (int, optional): number of entries
+        """
+        if self.samples == 0:
+            return
+        print('samples:', self.samples)
+        print('%7s  function (inclusive)' % '%')
+        for (filename, function), count in self.inclusive.most_common(top):
+            print('%6.1f%%  %s:%s' % (count/self.samples*100, filename, function))
+        print('%7s  line (own)' % '%')
+        for (filename, function, line), count in self.own.most_common(top):
+            print('%6.1f%%  %s:%d %s' % (count/self.samples*100, filename, line, function))
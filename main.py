@@ -1,81 +1,153 @@
+import argparse
+import shlex
 import time
-import cv2
-from pynput.mouse import Button, Controller
+from collections import deque
+from functools import partial
+import actuate
+import calibration
+import instrument
+from background import Background
+from cadence import EFFORT_FULL, EFFORT_NO_HOUGH, EFFORT_REDUCED, FrameCadence
+from device import RAW_FORMATS, DeviceScreen
+from gatestate import GateReader
 from grid import Grid
+from instrument import span
+from pipeline import Pipeline
+from planner import Planner
+from record import FrameRecorder
+from runlog import RunLog
+from scheduler import ClickScheduler
 from screen import Screen
-from util import find_items
-
-mouse = Controller()
+from tracker import Tracker
+from workspace import Workspace
 
 
 class Game():
 
-    def __init__(self):
-        self.screen = Screen()
+    def __init__(self, record=None, log='log.ndjson', proc_scale=1.0, cache='.calibration',
+                 screen=None, actuator='auto', clock=None, background=True, reduced_scale=0.5, readback=True):
+        """
+        Args:
+            record (string, optional): directory to record the captured frames to
+            log (string, optional): run log, see runlog.py
+            proc_scale (float, optional): resolution of the train detection relative to the
+                calibration image (750 px high). Gates and stations are always calibrated at full resolution.
+            cache (string, optional): directory of the calibration cache, None to always calibrate
+            screen (optional): frame source with get_image, x, y and scale, e.g. device.DeviceScreen. Screen() if None.
+            actuator (string or ActuatorBackend, optional): click backend, see actuate.make_actuator
+            clock (callable, optional): time source in seconds. time.time if None.
+            background (bool, optional): detect the trains by comparing with the calibration frame,
+                see background.py. If False, the whole frame is thresholded.
+            reduced_scale (float, optional): factor of proc_scale at the reduced effort level, see cadence.py
+            readback (bool, optional): read the gate states from the frames and repeat lost clicks,
+                see gatestate.py. If False, every click is assumed to switch its gate.
+        """
+        self.proc_scale = proc_scale
+        self.reduced_scale = reduced_scale
+        self.frame_scale = proc_scale
+        # background work for the spare time between frames
+        self.tasks = deque()
+        self.screen = screen if screen is not None else Screen()
+        if isinstance(actuator, str):
+            actuator = actuate.make_actuator(actuator)
+        self.actuator = actuator
+        self.clock = clock if clock is not None else time.time
+        self.log = RunLog(log)
+        self.recorder = None
+        if record is not None:
+            self.recorder = FrameRecorder(record)
+        # a device frame source has no window to locate, and a window assigned
+        # to the screen (see supervisor.py) must not be replaced by a cached one
+        window_cache = cache is not None and isinstance(self.screen, Screen) and self.screen.anchor is None
+        if window_cache:
+            calibration.load_window(cache, self.screen)
         img = self.screen.get_image()
-        self.mygrid = Grid(img)
+        if self.recorder is not None:
+            self.recorder.add(img, self.clock())
+        self.mygrid = None
+        if cache is not None:
+            self.mygrid = calibration.load_grid(cache, img)
+        if self.mygrid is None:
+            self.mygrid = Grid(img)
+            if cache is not None:
+                self.tasks.append(partial(calibration.write_grid, cache, calibration.grid_record(self.mygrid, img)))
+        if window_cache:
+            self.tasks.append(partial(calibration.save_window, cache, self.screen))
+        self.planner = Planner(self.mygrid)
+        # frame and detection buffers of the game loop, allocated once per resolution
+        self.workspace = Workspace()
+        self.tracker = Tracker(background=Background(img, self.mygrid) if background else None, workspace=self.workspace)
+        if self.tracker.background is not None:
+            reduced = proc_scale*reduced_scale
+            self.tasks.append(partial(self.tracker.background.get_level, (int(img.shape[0]*reduced), int(img.shape[1]*reduced))))
+        self.scheduler = ClickScheduler()
+        self.reader = GateReader(self.mygrid, workspace=self.workspace) if readback else None
+        self.log.grid(self.mygrid)
 
-    def run(self):
-        """
-        Runs the game for 160 seconds
+    def run(self, duration=160, rate=30):
         """
+        Runs the game
 
-        start_time = time.time()
+        Args:
+            duration (int, optional): run time in seconds
+            rate (float, optional): target frames per second, None to run as fast as possible
+
+        Returns:
+            int: number of frames
+        """
+        efforts = (EFFORT_FULL, EFFORT_NO_HOUGH, EFFORT_REDUCED)
+        if self.tracker.background is not None:
+            # the background model never runs the Hough check
+            efforts = (EFFORT_FULL, EFFORT_REDUCED)
+        cadence = FrameCadence(1/rate if rate else None, efforts=efforts)
+        start_time = self.clock()
         step_number = 0
         while True:
-            self.switch_gates(step_number)
+            self.set_effort(cadence.begin())
+            try:
+                self.switch_gates(step_number)
+            except (EOFError, OSError) as error:
+                # the frame source has no more frames or does not respond, the run ends cleanly
+                print(error)
+                break
             step_number+=1
-            if time.time()-start_time > 160:
+            cadence.end(self.tasks)
+            if self.clock()-start_time > duration:
                 break
+        self.close()
+        cadence.report()
         print('end')
+        return step_number
 
-    def find_path(self, start, goal, way):
-        """Append a cell to the path
+    def set_effort(self, level):
+        """Sets the processing effort of the next frame
 
         Args:
-            start (int): grid number of last cell
-            goal (int): grid number of target cell
-            way (list): list of grid number already part of the path
-
-        Returns:
-            list: list of grid numbers
+            level (int): effort level, see cadence.py
         """
-        if len(way) > 15:
-            return False
-        if start == goal:
-            return way
-        if self.mygrid.points[start]['type'] == 'station':
-            return False
-        way.append(start)
-        for direction in self.mygrid.points[start]['directions']:
-            res = self.find_path(direction, goal, way)
-            if res is not False:
-                return res
-        del way[-1]
-        return False
-
-    def find_path_init(self, train):
-        """Initializes path finding for a train
-
-        Args:
-            train
+        self.tracker.reject_track = self.tracker.background is None and level < EFFORT_NO_HOUGH
+        self.frame_scale = self.proc_scale*(self.reduced_scale if level >= EFFORT_REDUCED else 1)
 
-        Returns:
-            array: list of cells to pass
-            goal: target cell
+    def close(self):
+        """Writes the remaining log records and recorded frames
+        and prints the stage timings if instrumentation is on
         """
-        start = train[0]
-        goal = -1
-        for idx, point in enumerate(self.mygrid.points):
-            if point['type'] == 'station' and train[2] == point['color']:
-                goal = idx
-        if goal < 0:
-            return False, False
-        way = self.find_path(start, goal, [])
-        if way is not False and train[1]-int(train[1]) > 0.4:
-            way = way[1:]
-        return way, goal
-
+        while self.tasks:
+            self.tasks.popleft()()
+        if self.recorder is not None:
+            self.recorder.close()
+        self.log.close()
+        print('clicks:', self.scheduler.n_clicks, 'coalesced:', self.scheduler.n_coalesced)
+        # the tracker only classifies the detections it cannot associate with a known train
+        print('trains detected:', self.tracker.n_detected, 'classified:', self.tracker.n_classified)
+        print('frame buffers allocated:', self.workspace.n_allocations)
+        stats = self.actuator.stats()
+        print('click batch latency [ms] (%s, %d batches): mean %.2f p95 %.2f max %.2f' % (
+            stats['backend'], stats['batches'], stats['mean']*1000, stats['p95']*1000, stats['max']*1000))
+        self.actuator.close()
+        if self.reader is not None:
+            print('gate reads:', self.reader.n_reads, 'corrected:', self.reader.n_corrections, 'learned:', self.reader.n_learned)
+        instrument.summary()
 
     def switch_gates(self, step):
         """Performs one step
@@ -83,64 +155,116 @@ class Game():
         Args:
             step (int): step number for debugging
         """
-        f2 = open('log.dat', 'a')
-        f2.write('--'+str(step)+'--\n')
+        timestamp = self.clock()
         start_time = time.time()
+        record = self.log.begin(step, timestamp)
 
-        img = self.screen.get_image()
+        img = self.screen.get_image(self.frame_scale, self.workspace)
 
         sec1_time = time.time()
-        f2.write(str(sec1_time-start_time)+'\n')
+        record.timings['capture'] = sec1_time-start_time
 
-        trains, n_stations = find_items(img, stations=False)
-        if n_stations != self.mygrid.n_stations:
-            f2.write('wrong number of stations detected\n')
-            f2.close()
-            return
-        #cv2.imwrite('pic/'+str(step)+'.png', img)
-        trainlist = []
-
-        for train in trains:
-            grid_nr = self.mygrid.get_grid_nr(train)
-            distance = self.mygrid.get_distance(train)
-            if grid_nr == 'error':
-                continue
-            if train['color'] == 'unknown':
-                continue
-            if self.mygrid.points[grid_nr]['type'] != 'station' and grid_nr != 1:
-                trainlist.append([grid_nr, distance, train['color']])
-
-        trainlist.sort(key=lambda x: x[1])
-
-        for train in trainlist:
-            path, goal = self.find_path_init(train)
-            if path is not False:
-                gates_pass = path
-                goals_pass = path[1:]+[goal]
-                f2.write(str(train)+'\n')
-                f2.write(str(gates_pass)+'\n')
-                for idx in range(len(gates_pass)):
-                    self.mygrid.points[gates_pass[idx]]['state'] = goals_pass[idx]
-
-        for point in self.mygrid.points:
-            if point['type'] == 'gate':
-                if point['state'] != point['ostate']:
-                    f2.write('switch gate '+str(point['grid_nr'])+' from '+str(point['ostate'])+' to '+str(point['state'])+'\n')
-                    mouse.position = (point['x']*self.screen.scale+self.screen.x, point['y']*self.screen.scale+self.screen.y)
-                    mouse.click(Button.left, 1)
-                    point['ostate'] = point['state']
+        switches = self.find_switches(img, timestamp, record)
+        with span('game.click'):
+            self.click(switches)
 
         end_time = time.time()
-        f2.write(str(end_time-sec1_time)+'\n')
+        record.timings['process'] = end_time-sec1_time
+        self.log.commit(record)
+
+    def find_switches(self, img, timestamp, record):
+        """Detects the trains of a frame and plans the gate states
+
+        Args:
+            img (RGB-image): resized screenshot of the smartphone window at frame_scale
+            timestamp (float): capture time in seconds
+            record (Record): log record of the frame
+
+        Returns:
+            list: grid numbers of the gates to click, most urgent first
+        """
+        if self.recorder is not None:
+            self.recorder.add(img, timestamp)
+
+        trains, n_stations = self.tracker.update(img, timestamp, self.frame_scale)
+        if n_stations != self.mygrid.n_stations:
+            record.message = 'wrong number of stations detected'
+            return []
+
+        with span('game.plan'):
+            routed = self.planner.plan(trains, timestamp)
+        for train, path in routed:
+            record.trains.append([train[3], train[0], train[1], train[2]])
+            record.routes.append([train[3], [cell for cell, _ in path]])
 
-        f2.close()
+        if self.reader is not None:
+            with span('game.gates'):
+                corrected = self.reader.update(img, trains, timestamp)
+            if len(corrected) > 0:
+                record.message = 'gate states corrected: %s' % ' '.join(str(gate) for gate in corrected)
+        switches = self.scheduler.update(self.planner.pending_switches(), self.mygrid.state, self.planner.arrivals, timestamp)
+        for gate in switches:
+            record.switches.append([gate, self.mygrid.ostate[gate], self.mygrid.state[gate]])
+        self.mygrid.ostate[switches] = self.mygrid.state[switches]
+        if self.reader is not None:
+            self.reader.clicked(switches, timestamp)
+        return switches
+
+    def click(self, gates):
+        """Clicks on gates in one batch
+
+        Args:
+            gates (list): grid numbers of the gates, most urgent first
+        """
+        self.actuator.click([self.actuator.target(self.mygrid.xs[gate], self.mygrid.ys[gate], self.screen) for gate in gates])
 
 
-game = Game()
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Plays Train of Thought (level 14)')
+    parser.add_argument('--record', metavar='DIR', help='record the captured frames for replay.py')
+    parser.add_argument('--pipelined', action='store_true', help='run capture, detection and clicks in separate stages')
+    parser.add_argument('--scale', type=float, default=1.0, help='resolution of the train detection, e.g. 0.5')
+    parser.add_argument('--no-cache', action='store_true', help='ignore the cached window location and track graph')
+    parser.add_argument('--no-background', action='store_true', help='detect the trains by thresholding the whole frame')
+    parser.add_argument('--no-readback', action='store_true', help='assume that every click switches its gate instead of reading the gate states')
+    parser.add_argument('--actuator', default='auto', choices=['auto']+list(actuate.BACKENDS)+['stub'],
+                        help='click backend: X events (xtest), pynput, or taps through adb shell (shell)')
+    parser.add_argument('--shell-command', metavar='CMD', default='adb shell',
+                        help='command that starts the device shell of the shell backend, e.g. "adb -s SERIAL shell"')
+    parser.add_argument('--device', metavar='SOURCE', help='read the screen stream of the device (file, pipe or URL) instead of the desktop')
+    parser.add_argument('--device-command', metavar='CMD', help='read the screen stream of the device from the output of a command, '
+                        'e.g. "adb exec-out screenrecord --output-format=raw-frames -"')
+    parser.add_argument('--device-size', default='1080x2400', help='width x height of the raw device frames')
+    parser.add_argument('--device-format', default='rgb24', choices=list(RAW_FORMATS)+['video'], help='pixel format of the device stream')
+    parser.add_argument('--device-fps', type=float, help='frames per second to read a file that stands in for the device stream')
+    parser.add_argument('--duration', type=float, default=160, help='run time in seconds')
+    parser.add_argument('--rate', type=float, default=30, help='target frames per second, 0 to run as fast as possible')
+    parser.add_argument('--instrument', action='store_true', help='print latency percentiles of every stage at the end')
+    parser.add_argument('--profile', action='store_true', help='sample the stack of the game loop and print the hottest functions at the end')
+    args = parser.parse_args()
 
-f1 = open('log.dat', 'w')
-f1.write(str(game.mygrid.grid))
-f1.write(str(game.mygrid.points))
-f1.close()
+    if args.instrument:
+        instrument.enable()
+    actuator = args.actuator
+    if actuator == 'shell':
+        actuator = actuate.make_actuator('shell', command=shlex.split(args.shell_command))
+    screen = None
+    if args.device or args.device_command:
+        screen = DeviceScreen(shlex.split(args.device_command) if args.device_command else args.device,
+                              tuple(int(value) for value in args.device_size.split('x')), args.device_format, args.device_fps)
+    game = Game(record=args.record, screen=screen, proc_scale=args.scale, cache=None if args.no_cache else '.calibration',
+                background=not args.no_background, readback=not args.no_readback, actuator=actuator)
 
-game.run()
+    profiler = None
+    if args.profile:
+        profiler = instrument.SamplingProfiler()
+        profiler.start()
+    if args.pipelined:
+        Pipeline(game).run(args.duration)
+    else:
+        game.run(args.duration, args.rate or None)
+    if profiler is not None:
+        profiler.stop()
+        profiler.report()
+    if screen is not None:
+        screen.close()
@@ -0,0 +1,132 @@
+import queue
+import threading
+import time
+import numpy as np
+from instrument import span
+
+
+class LatestQueue():
+    """Queue that only keeps the newest item, older items are dropped
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.item = None
+        self.dropped = 0
+
+    def put(self, item):
+        with self.condition:
+            if self.item is not None:
+                self.dropped += 1
+            self.item = item
+            self.condition.notify()
+
+    def get(self, timeout=None):
+        """Returns the newest item
+
+        Args:
+            timeout (float, optional): maximal waiting time in seconds
+
+        Returns:
+            newest item, None after a timeout
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.item is not None, timeout)
+            item = self.item
+            self.item = None
+            return item
+
+    def empty(self):
+        with self.condition:
+            return self.item is None
+
+
+class Pipeline():
+    """Runs capture, detection and clicks of a game in separate stages.
+    The capture thread always overwrites the pending frame, so the detection
+    stage works on the newest frame and stale frames are dropped. Clicks are
+    issued by their own worker, so a slow click does not delay the next capture.
+    """
+
+    def __init__(self, game, max_clicks=16):
+        """
+        Args:
+            game (Game): calibrated game
+            max_clicks (int, optional): maximal number of pending clicks
+        """
+        self.game = game
+        self.frames = LatestQueue()
+        self.clicks = queue.Queue(maxsize=max_clicks)
+        self.stop = threading.Event()
+        self.latencies = []
+
+    def capture(self):
+        while not self.stop.is_set():
+            start_time = time.perf_counter()
+            timestamp = self.game.clock()
+            try:
+                # queued frames must not share the buffer of the workspace
+                img = self.game.screen.get_image(self.game.frame_scale)
+            except (EOFError, OSError) as error:
+                # the frame source has no more frames or does not respond, all stages stop
+                print(error)
+                self.stop.set()
+                return
+            self.frames.put((start_time, timestamp, img))
+
+    def actuate(self):
+        stop = False
+        while not stop:
+            items = [self.clicks.get()]
+            # the pending clicks are issued in one batch
+            while not self.clicks.empty():
+                items.append(self.clicks.get())
+            stop = None in items
+            items = [item for item in items if item is not None]
+            with span('game.click'):
+                self.game.click([gate for _, gate in items])
+            end_time = time.perf_counter()
+            self.latencies.extend(end_time-start_time for start_time, _ in items)
+
+    def run(self, duration=160):
+        """Runs the game
+
+        Args:
+            duration (int, optional): run time in seconds
+        """
+        threads = [threading.Thread(target=self.capture, daemon=True), threading.Thread(target=self.actuate, daemon=True)]
+        for thread in threads:
+            thread.start()
+
+        start_time = self.game.clock()
+        step_number = 0
+        while not self.stop.is_set() and self.game.clock()-start_time < duration:
+            frame = self.frames.get(timeout=1)
+            if frame is None:
+                continue
+            capture_time, timestamp, img = frame
+            record = self.game.log.begin(step_number, timestamp)
+            for gate in self.game.find_switches(img, timestamp, record):
+                self.clicks.put((capture_time, gate))
+            record.timings['latency'] = time.perf_counter()-capture_time
+            self.game.log.commit(record)
+            step_number += 1
+            # background tasks run one at a time while no newer frame is waiting
+            if self.game.tasks and self.frames.empty():
+                self.game.tasks.popleft()()
+
+        self.stop.set()
+        self.clicks.put(None)
+        for thread in threads:
+            thread.join()
+        self.game.close()
+        self.report(step_number)
+
+    def report(self, n_frames):
+        """Prints the number of processed and dropped frames and the capture-to-click latency
+        """
+        print('frames processed:', n_frames, 'dropped:', self.frames.dropped)
+        if len(self.latencies) > 0:
+            latencies = np.array(self.latencies)*1000
+            print('capture to click [ms]: mean %.1f p95 %.1f max %.1f' % (latencies.mean(), np.percentile(latencies, 95), latencies.max()))
+        print('end')
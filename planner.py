@@ -0,0 +1,171 @@
+import time
+import numpy as np
+from grid import CELL_ERROR, ENTRY_LENGTH, TYPE_GATE, TYPE_STATION
+from instrument import span
+
+
+class Planner():
+    """Plans the gate states for the detected trains
+    """
+
+    def __init__(self, grid, min_speed=0.5):
+        """
+        Args:
+            grid (Grid): calibrated grid
+            min_speed (float, optional): assumed speed in cells per second of trains without velocity estimate
+        """
+        self.mygrid = grid
+        self.min_speed = min_speed
+        self.trains = {}
+        self.reservations = {}
+        self.first_arrival = {}
+        self.arrivals = {}
+
+    def get_trainlist(self, trains):
+        """Assigns the detected trains to cells and sorts them by distance from start
+
+        Args:
+            trains (list): trains found by find_items
+
+        Returns:
+            list: list of [grid number, distance, color, train id, speed in cells per second]
+        """
+        trains = [train for train in trains if train['color'] != 'unknown']
+        if len(trains) == 0:
+            return []
+        xs = np.array([train['x'] for train in trains])
+        ys = np.array([train['y'] for train in trains])
+        grid_nrs = self.mygrid.get_grid_nrs(xs, ys)
+        distances = self.mygrid.get_distances(xs, ys)
+        valid = (grid_nrs != CELL_ERROR) & (self.mygrid.types[grid_nrs] != TYPE_STATION) & (grid_nrs != 1)
+
+        trainlist = []
+        for idx in np.flatnonzero(valid)[np.argsort(distances[valid], kind='stable')]:
+            speed = np.hypot(trains[idx].get('vx', 0), trains[idx].get('vy', 0))/100
+            trainlist.append([grid_nrs[idx], distances[idx], trains[idx]['color'], trains[idx].get('id'), speed])
+        return trainlist
+
+    def find_path_init(self, train):
+        """Looks up the path of a train in the routing table
+
+        Args:
+            train
+
+        Returns:
+            list: list of (grid number, state) pairs to set
+        """
+        route = self.mygrid.get_route(train[0], train[2])
+        if route is None:
+            return False
+        if train[1]-int(train[1]) > 0.4:
+            route = route[1:]
+        return route
+
+    def plan(self, trains, now=None):
+        """Sets the target state of the gates for the detected trains.
+
+        Every routed train reserves the gates on its route with the state it
+        needs and its estimated arrival time. A gate is set to the state of
+        the earliest reservation, so a later train cannot overwrite the gate
+        of a train that arrives first. Only trains whose cell, color or
+        in-cell position changed since the last frame are planned again, and
+        only the gates they touch are resolved again. A reservation is
+        released when the train leaves its cell or disappears.
+        self.arrivals holds the estimated time in seconds until the first
+        train reaches each reserved gate.
+
+        Args:
+            trains (list): trains found by find_items or the tracker
+            now (float, optional): capture time in seconds
+
+        Returns:
+            list: list of (train, path) for every routed train
+        """
+        if now is None:
+            now = time.time()
+        with span('plan.trainlist'):
+            trainlist = self.get_trainlist(trains)
+
+        dirty = set()
+        # untracked trains have no identity across frames and are planned every frame
+        for train_id in [train_id for train_id in self.trains if isinstance(train_id, tuple)]:
+            self.release(train_id, dirty)
+
+        routed = []
+        seen = set()
+        for idx, train in enumerate(trainlist):
+            train_id = train[3] if train[3] is not None else ('untracked', idx)
+            seen.add(train_id)
+            key = (train[0], train[2], train[1]-int(train[1]) > 0.4)
+            entry = self.trains.get(train_id)
+            if entry is None or entry['key'] != key:
+                self.release(train_id, dirty)
+                entry = self.reserve(train_id, train, key, now, dirty)
+            if entry['path'] is not False:
+                routed.append((train, entry['path']))
+
+        for train_id in [train_id for train_id in self.trains if train_id not in seen]:
+            self.release(train_id, dirty)
+
+        for gate in dirty:
+            reservations = self.reservations.get(gate)
+            if not reservations:
+                self.reservations.pop(gate, None)
+                self.first_arrival.pop(gate, None)
+                continue
+            arrival, state = min(reservations.values())
+            self.mygrid.state[gate] = state
+            self.first_arrival[gate] = arrival
+        self.arrivals = {gate: max(arrival-now, 0) for gate, arrival in self.first_arrival.items()}
+        return routed
+
+    def reserve(self, train_id, train, key, now, dirty):
+        """Plans the route of a train and reserves its gates
+
+        Args:
+            train_id: id of the train
+            train: entry of the trainlist
+            key (tuple): cell, color and in-cell position the route is valid for
+            now (float): capture time in seconds
+            dirty (set): gates whose reservations changed
+
+        Returns:
+            dict: planned train
+        """
+        path = self.find_path_init(train)
+        entry = {'key': key, 'path': path, 'gates': []}
+        if path is not False:
+            speed = max(train[4], self.min_speed)
+            for cell, state in path:
+                if self.mygrid.types[cell] != TYPE_GATE:
+                    self.mygrid.state[cell] = state
+                    continue
+                remaining = max(self.mygrid.distance[cell]+ENTRY_LENGTH/100-train[1], 0)
+                self.reservations.setdefault(cell, {})[train_id] = (now+remaining/speed, state)
+                entry['gates'].append(cell)
+                dirty.add(cell)
+        self.trains[train_id] = entry
+        return entry
+
+    def release(self, train_id, dirty):
+        """Removes a train and its gate reservations
+
+        Args:
+            train_id: id of the train
+            dirty (set): gates whose reservations changed
+        """
+        entry = self.trains.pop(train_id, None)
+        if entry is None:
+            return
+        for gate in entry['gates']:
+            self.reservations.get(gate, {}).pop(train_id, None)
+            dirty.add(gate)
+
+    def pending_switches(self):
+        """Returns the gates whose target state differs from their current state
+
+        Returns:
+            array: grid numbers of the gates
+        """
+        gates = self.mygrid.gates
+        return gates[self.mygrid.state[gates] != self.mygrid.ostate[gates]]
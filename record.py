@@ -0,0 +1,89 @@
+import os
+import queue
+import threading
+import cv2
+import numpy as np
+
+
+class FrameRecorder():
+    """Records frames to a directory.
+    Frames are PNG-compressed and appended to frames.bin by a background
+    thread, index.csv holds frame number, timestamp, offset and length
+    of every frame.
+    """
+
+    def __init__(self, directory, compression=1):
+        """
+        Args:
+            directory (string): output directory
+            compression (int, optional): PNG compression level (0-9)
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.compression = compression
+        self.queue = queue.Queue()
+        self.frame_nr = 0
+        self.thread = threading.Thread(target=self._write, daemon=True)
+        self.thread.start()
+
+    def add(self, img, timestamp):
+        """Queues a frame for recording
+
+        Args:
+            img (RGB-image): captured frame
+            timestamp (float): capture time in seconds
+        """
+        self.queue.put((self.frame_nr, timestamp, img.copy()))
+        self.frame_nr += 1
+
+    def _write(self):
+        with open(os.path.join(self.directory, 'frames.bin'), 'wb') as frames, \
+                open(os.path.join(self.directory, 'index.csv'), 'w') as index:
+            index.write('frame,timestamp,offset,length\n')
+            offset = 0
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+                frame_nr, timestamp, img = item
+                _, data = cv2.imencode('.png', img, [cv2.IMWRITE_PNG_COMPRESSION, self.compression])
+                frames.write(data.tobytes())
+                index.write(str(frame_nr)+','+repr(timestamp)+','+str(offset)+','+str(len(data))+'\n')
+                offset += len(data)
+
+    def close(self):
+        """Writes the remaining frames and closes the recording
+        """
+        self.queue.put(None)
+        self.thread.join()
+
+
+class FrameReader():
+    """Reads a recording written by FrameRecorder
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.index = []
+        with open(os.path.join(directory, 'index.csv')) as index:
+            next(index)
+            for line in index:
+                frame_nr, timestamp, offset, length = line.strip().split(',')
+                self.index.append((int(frame_nr), float(timestamp), int(offset), int(length)))
+
+    def __len__(self):
+        return len(self.index)
+
+    def __iter__(self):
+        """Iterates over the recorded frames
+
+        Yields:
+            int: frame number
+            float: timestamp
+            RGB-image: frame
+        """
+        with open(os.path.join(self.directory, 'frames.bin'), 'rb') as frames:
+            for frame_nr, timestamp, offset, length in self.index:
+                frames.seek(offset)
+                data = np.frombuffer(frames.read(length), dtype=np.uint8)
+                yield frame_nr, timestamp, cv2.imdecode(data, cv2.IMREAD_COLOR)
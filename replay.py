@@ -0,0 +1,86 @@
+import argparse
+import time
+import numpy as np
+import instrument
+from background import Background
+from grid import Grid
+from planner import Planner
+from record import FrameReader
+from scheduler import ClickScheduler
+from tracker import Tracker
+
+
+def replay(directory, repeat=1, background=True):
+    """Feeds a recording through Grid, the tracker and the planner
+
+    Args:
+        directory (string): recording written by FrameRecorder
+        repeat (int, optional): number of passes over the recording
+        background (bool, optional): detect the trains with the background model of the first frame
+
+    Returns:
+        dict: list of latencies in seconds per stage
+        int: number of processed frames
+    """
+    reader = FrameReader(directory)
+    frames = [(timestamp, img) for _, timestamp, img in reader]
+    if len(frames) == 0:
+        raise ValueError('empty recording: '+directory)
+
+    timings = {'grid': [], 'detect': [], 'plan': [], 'frame': []}
+    n_frames = 0
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        mygrid = Grid(frames[0][1])
+        timings['grid'].append(time.perf_counter()-start_time)
+        planner = Planner(mygrid)
+        tracker = Tracker(background=Background(frames[0][1], mygrid) if background else None)
+        scheduler = ClickScheduler()
+        for timestamp, img in frames[1:]:
+            # frames recorded with --scale are smaller than the calibration frame
+            proc_scale = img.shape[0]/frames[0][1].shape[0]
+            start_time = time.perf_counter()
+            trains, n_stations = tracker.update(img, timestamp, proc_scale)
+            sec1_time = time.perf_counter()
+            timings['detect'].append(sec1_time-start_time)
+            if n_stations == mygrid.n_stations:
+                planner.plan(trains, timestamp)
+                switches = scheduler.update(planner.pending_switches(), mygrid.state, planner.arrivals, timestamp)
+                mygrid.ostate[switches] = mygrid.state[switches]
+            end_time = time.perf_counter()
+            timings['plan'].append(end_time-sec1_time)
+            timings['frame'].append(end_time-start_time)
+            n_frames += 1
+    return timings, n_frames
+
+
+def report(timings, n_frames):
+    """Prints the latency distribution of every stage
+
+    Args:
+        timings (dict): list of latencies in seconds per stage
+        n_frames (int): number of processed frames
+    """
+    print('stage        count     mean      p50      p95      p99      max  [ms]')
+    for stage, values in timings.items():
+        if len(values) == 0:
+            continue
+        values = np.array(values)*1000
+        p50, p95, p99 = np.percentile(values, [50, 95, 99])
+        print('%-10s %7d %8.2f %8.2f %8.2f %8.2f %8.2f' % (stage, len(values), values.mean(), p50, p95, p99, values.max()))
+    total = sum(timings['frame'])
+    if total > 0:
+        print('frames/sec: %.1f' % (n_frames/total))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replays a recorded run without screen and mouse')
+    parser.add_argument('directory', help='recording directory (python main.py --record DIR)')
+    parser.add_argument('--repeat', type=int, default=1, help='number of passes over the recording')
+    parser.add_argument('--instrument', action='store_true', help='also print the timings of the instrumented sub-stages')
+    parser.add_argument('--no-background', action='store_true', help='detect the trains by thresholding the whole frame')
+    args = parser.parse_args()
+    if args.instrument:
+        instrument.enable()
+    report(*replay(args.directory, args.repeat, not args.no_background))
+    instrument.summary()
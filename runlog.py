@@ -0,0 +1,201 @@
+import argparse
+import json
+import threading
+import numpy as np
+
+
+class Record():
+    """Log record of one frame
+    """
+    __slots__ = ['kind', 'frame', 'time', 'timings', 'trains', 'routes', 'switches', 'message']
+
+    def __init__(self):
+        self.timings = {}
+        self.trains = []
+        self.routes = []
+        self.switches = []
+        self.reset('frame', 0, 0)
+
+    def reset(self, kind, frame, timestamp):
+        self.kind = kind
+        self.frame = frame
+        self.time = timestamp
+        self.timings.clear()
+        self.trains.clear()
+        self.routes.clear()
+        self.switches.clear()
+        self.message = None
+
+    def to_dict(self):
+        return {
+            'kind': self.kind,
+            'frame': self.frame,
+            'time': self.time,
+            'timings': self.timings,
+            'trains': self.trains,
+            'routes': self.routes,
+            'switches': self.switches,
+            'message': self.message
+        }
+
+
+def to_json(value):
+    """Converts numpy values for json.dumps
+    """
+    if isinstance(value, np.integer):
+        return int(value)
+    if isinstance(value, np.floating):
+        return float(value)
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError('cannot serialize '+str(type(value)))
+
+
+class RunLog():
+    """Structured run log.
+    Records live in a preallocated ring buffer and are written as NDJSON by a
+    background thread, so the game loop never waits for the disk. If the
+    writer falls behind, the oldest records are dropped.
+    """
+
+    def __init__(self, path='log.ndjson', capacity=1024, interval=0.5):
+        """
+        Args:
+            path (string, optional): output file, overwritten
+            capacity (int, optional): number of records in the ring buffer
+            interval (float, optional): flush interval in seconds
+        """
+        self.path = path
+        self.interval = interval
+        self.ring = [Record() for _ in range(capacity)]
+        self.read = 0
+        self.write = 0
+        self.dropped = 0
+        self.extra = []
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.closed = False
+        self.thread = threading.Thread(target=self._flush_loop, daemon=True)
+        self.thread.start()
+
+    def begin(self, frame, timestamp=0):
+        """Returns an empty record for a frame. The record is logged by commit.
+
+        Args:
+            frame (int): frame number
+            timestamp (float, optional): capture time in seconds
+
+        Returns:
+            Record: record to fill
+        """
+        with self.lock:
+            if self.write-self.read >= len(self.ring):
+                self.read += 1
+                self.dropped += 1
+            record = self.ring[self.write % len(self.ring)]
+            record.reset('frame', frame, timestamp)
+        return record
+
+    def commit(self, record):
+        """Queues the record returned by the last begin for writing
+        """
+        with self.lock:
+            self.write += 1
+
+    def grid(self, mygrid):
+        """Logs the track graph of a grid
+
+        Args:
+            mygrid (Grid): calibrated grid
+        """
+        line = json.dumps({'kind': 'grid', 'grid': mygrid.grid, 'points': mygrid.points}, default=to_json)
+        with self.lock:
+            self.extra.append(line)
+        self.wakeup.set()
+
+    def _collect(self):
+        with self.lock:
+            lines = self.extra
+            self.extra = []
+            for idx in range(self.read, self.write):
+                lines.append(json.dumps(self.ring[idx % len(self.ring)].to_dict(), default=to_json))
+            self.read = self.write
+        return lines
+
+    def _flush_loop(self):
+        with open(self.path, 'w') as log_file:
+            while True:
+                self.wakeup.wait(self.interval)
+                self.wakeup.clear()
+                lines = self._collect()
+                if len(lines) > 0:
+                    log_file.write('\n'.join(lines)+'\n')
+                    log_file.flush()
+                if self.closed:
+                    break
+
+    def close(self):
+        """Writes the remaining records and stops the writer
+        """
+        self.closed = True
+        self.wakeup.set()
+        self.thread.join()
+
+
+def read_log(path):
+    """Reads a run log
+
+    Args:
+        path (string): NDJSON log written by RunLog
+
+    Returns:
+        list: list of records as dicts
+    """
+    with open(path) as log_file:
+        return [json.loads(line) for line in log_file if line.strip()]
+
+
+def print_tables(records, table='frames'):
+    """Prints the records of a run log as table
+
+    Args:
+        records (list): records returned by read_log
+        table (string, optional): 'frames', 'trains', 'routes' or 'switches'
+    """
+    frames = [record for record in records if record['kind'] == 'frame']
+    if table == 'frames':
+        stages = []
+        for record in frames:
+            for stage in record['timings']:
+                if stage not in stages:
+                    stages.append(stage)
+        print('%7s' % 'frame'+''.join('%12s' % (stage+'[ms]') for stage in stages)+'%8s%10s  message' % ('trains', 'switches'))
+        for record in frames:
+            print('%7d' % record['frame']
+                  +''.join('%12.2f' % (record['timings'][stage]*1000) if stage in record['timings'] else '%12s' % '-' for stage in stages)
+                  +'%8d%10d  %s' % (len(record['trains']), len(record['switches']), record['message'] or ''))
+    elif table == 'trains':
+        print('%7s%6s%8s%10s  color' % ('frame', 'id', 'cell', 'distance'))
+        for record in frames:
+            for train_id, grid_nr, distance, color in record['trains']:
+                print('%7d%6s%8d%10.2f  %s' % (record['frame'], train_id, grid_nr, distance, color))
+    elif table == 'routes':
+        print('%7s%6s  cells' % ('frame', 'id'))
+        for record in frames:
+            for train_id, cells in record['routes']:
+                print('%7d%6s  %s' % (record['frame'], train_id, cells))
+    elif table == 'switches':
+        print('%7s%6s%6s%6s' % ('frame', 'gate', 'from', 'to'))
+        for record in frames:
+            for gate, ostate, state in record['switches']:
+                print('%7d%6d%6d%6d' % (record['frame'], gate, ostate, state))
+    else:
+        raise ValueError('unknown table: '+table)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Prints a run log as table')
+    parser.add_argument('path', nargs='?', default='log.ndjson', help='run log')
+    parser.add_argument('--table', default='frames', choices=['frames', 'trains', 'routes', 'switches'])
+    args = parser.parse_args()
+    print_tables(read_log(args.path), args.table)
@@ -0,0 +1,59 @@
+import numpy as np
+
+
+class ClickScheduler():
+    """Decides which pending gate switches are clicked and in which order.
+    Switches are fired in order of the arrival time of the next train at the
+    gate. Switches that are not urgent wait for a short window, so a switch
+    that is cancelled by the next plan costs no click. Switches for gates that
+    no train reaches within the horizon are deferred.
+    """
+
+    def __init__(self, horizon=5.0, urgent=0.5, window=0.15):
+        """
+        Args:
+            horizon (float, optional): switches for gates reached later than this (seconds) are deferred
+            urgent (float, optional): switches for gates reached earlier than this (seconds) are fired immediately
+            window (float, optional): time in seconds a non-urgent switch waits before it is fired
+        """
+        self.horizon = horizon
+        self.urgent = urgent
+        self.window = window
+        self.pending = {}
+        self.n_clicks = 0
+        self.n_coalesced = 0
+
+    def update(self, switches, targets, arrivals, now):
+        """Updates the pending switches and returns the gates to click now
+
+        Args:
+            switches (array): grid numbers of the gates whose target state differs from their current state
+            targets (array): target state of every cell
+            arrivals (dict): grid number -> estimated arrival time of the next train in seconds
+            now (float): time in seconds
+
+        Returns:
+            list: grid numbers of the gates to click, most urgent first
+        """
+        switches = set(int(gate) for gate in switches)
+        for gate in list(self.pending):
+            if gate not in switches:
+                # the gate is back in its current state before it was clicked
+                del self.pending[gate]
+                self.n_coalesced += 1
+        for gate in switches:
+            if gate not in self.pending or self.pending[gate][0] != targets[gate]:
+                self.pending[gate] = (targets[gate], now)
+
+        due = []
+        for gate, (_, since) in self.pending.items():
+            eta = arrivals.get(gate, np.inf)
+            if eta > self.horizon:
+                continue
+            if eta <= self.urgent or now-since >= self.window:
+                due.append((eta, gate))
+        due.sort()
+        for _, gate in due:
+            del self.pending[gate]
+        self.n_clicks += len(due)
+        return [gate for _, gate in due]
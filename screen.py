@@ -1,12 +1,32 @@
 import time
-import pyautogui
 import cv2
 import numpy as np
+from capture import make_backend
+from instrument import span
+from workspace import get_buffer
+
+# HSV range of the green border of the smartphone window
+LOWER_GREEN = np.array([50,100,50])
+UPPER_GREEN = np.array([80,140,120])
 
 class Screen():
     """captures screenshots of the smartphone window
     """
-    def __init__(self):
+    def __init__(self, backend='auto', coarse_factor=8, recheck_interval=1.0, window=None):
+        """
+        Args:
+            backend (string or CaptureBackend, optional): capture backend, see capture.make_backend
+            coarse_factor (int, optional): subsampling of the desktop for the coarse window search
+            recheck_interval (float, optional): seconds between the checks whether the window has moved
+            window (list, optional): x, y, width and height of the window to follow if there are
+                several windows. After a move the nearest window is taken, not the largest.
+        """
+        self.coarse_factor = coarse_factor
+        self.recheck_interval = recheck_interval
+        self.last_check = 0
+        if isinstance(backend, str):
+            backend = make_backend(backend)
+        self.backend = backend
         self.x = 0
         self.y = 0
         self.width = 0
@@ -14,62 +34,203 @@ class Screen():
         self.height = 0
         self.new_height = 0
         self.scale = 1
+        self.anchor = None
+        if window is not None:
+            self.anchor = (window[0]+window[2]/2, window[1]+window[3]/2)
+            self.set_field(window)
 
     def find_field(self, image):
-        """finds the smartphone window in the screenshot
+        """finds the smartphone window in the screenshot.
+        The window is first searched in a subsampled screenshot, the exact
+        rect is then searched at full resolution in a small region around it.
+
+        Args:
+            image ([BGR-image]): screenshot of the entire screen
+        """
+        factor = self.coarse_factor
+        if self.anchor is None:
+            rect = self.find_field_rect(image, factor)
+        else:
+            rects = [rect for rect in self.find_green_rects(image[::factor, ::factor]) if rect[3]*factor >= self.height/2]
+            rect = min(rects, key=lambda r: ((r[0]+r[2]/2)*factor-self.anchor[0])**2+((r[1]+r[3]/2)*factor-self.anchor[1])**2,
+                       default=None)
+            if rect is not None and factor > 1:
+                rect = self.refine_rect(image, rect, factor)
+        self.set_field(rect if rect is not None else [0,0,0,0])
+
+    @classmethod
+    def find_field_rect(cls, image, coarse_factor=8):
+        """finds the largest green area, coarse in a subsampled image and then exact around it
+
+        Args:
+            image ([BGR-image]): screenshot of the entire screen or frame of the device
+            coarse_factor (int, optional): subsampling for the coarse search
+
+        Returns:
+            list: x, y, width and height, None if there is no green area
+        """
+        rect = cls.find_green_rect(image[::coarse_factor, ::coarse_factor])
+        if rect is not None and coarse_factor > 1:
+            rect = cls.refine_rect(image, rect, coarse_factor)
+        return rect
+
+    @classmethod
+    def find_windows(cls, image, coarse_factor=8, min_height=100):
+        """finds all smartphone windows in a screenshot of the entire screen
 
         Args:
-            image ([RGB-image]): screenshot of the entire screen
+            image ([BGR-image]): screenshot of the entire screen
+            coarse_factor (int, optional): subsampling for the coarse search
+            min_height (int, optional): minimal height of a window in pixels
+
+        Returns:
+            list: rects (x, y, width, height) of the windows, ordered from left to right and top to bottom
+        """
+        rects = []
+        for rect in cls.find_green_rects(image[::coarse_factor, ::coarse_factor]):
+            if rect[3]*coarse_factor < min_height:
+                continue
+            if coarse_factor > 1:
+                rect = cls.refine_rect(image, rect, coarse_factor)
+            if rect is not None:
+                rects.append(rect)
+        return sorted(rects, key=lambda rect: (rect[0], rect[1]))
+
+    @classmethod
+    def refine_rect(cls, image, rect, factor):
+        """searches a rect of the subsampled screenshot again at full resolution
+
+        Args:
+            image ([BGR-image]): screenshot of the entire screen
+            rect (list): x, y, width and height in the screenshot subsampled by factor
+            factor (int): subsampling factor
+
+        Returns:
+            list: x, y, width and height at full resolution, None if the green area is gone
+        """
+        margin = 2*factor
+        left = max(rect[0]*factor-margin, 0)
+        top = max(rect[1]*factor-margin, 0)
+        right = min((rect[0]+rect[2])*factor+margin, image.shape[1])
+        bottom = min((rect[1]+rect[3])*factor+margin, image.shape[0])
+        rect = cls.find_green_rect(image[top:bottom, left:right])
+        if rect is None:
+            return None
+        return [rect[0]+left, rect[1]+top, rect[2], rect[3]]
+
+    @staticmethod
+    def find_green_rects(image):
+        """finds the bounding rects of all green areas
+
+        Args:
+            image ([BGR-image]): screenshot
+
+        Returns:
+            list: rects (x, y, width, height), largest first
         """
-        hsv = cv2.cvtColor(image, cv2.COLOR_RGB2HSV)
-        lower_green = np.array([50,100,50])
-        upper_green = np.array([80,140,120])
-
-        mask = cv2.inRange(hsv, lower_green, upper_green)
-        res = cv2.bitwise_and(hsv, hsv, mask=mask)
-        gray = cv2.cvtColor(res, cv2.COLOR_BGR2GRAY)
-        _,thresh = cv2.threshold(gray, 50, 255, cv2.THRESH_BINARY)
-        contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-
-        maxsize = 0
-        rect = [0,0,0,0]
-        for contour in contours:
-            (x, y, width, height) = cv2.boundingRect(contour)
-            if width*height > maxsize:
-                maxsize = width*height
-                rect = [x, y, width, height]
+        hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+        mask = cv2.inRange(hsv, LOWER_GREEN, UPPER_GREEN)
+        contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        rects = [list(cv2.boundingRect(contour)) for contour in contours]
+        return sorted(rects, key=lambda rect: rect[2]*rect[3], reverse=True)
+
+    @classmethod
+    def find_green_rect(cls, image):
+        """finds the bounding rect of the largest green area
+
+        Args:
+            image ([BGR-image]): screenshot
+
+        Returns:
+            list: x, y, width and height, None if there is no green area
+        """
+        rects = cls.find_green_rects(image)
+        if len(rects) == 0 or rects[0][2]*rects[0][3] == 0:
+            return None
+        return rects[0]
+
+    def set_field(self, rect):
+        """Sets the location of the smartphone window
+
+        Args:
+            rect (list): x, y, width and height of the window on the screen
+        """
+        if rect[3] == 0:
+            self.width = 0
+            return
         self.x = rect[0]
         self.y = rect[1]
         self.width = rect[2]
         self.height = rect[3]
         self.scale = self.height/750
+        if self.anchor is not None:
+            self.anchor = (self.x+self.width/2, self.y+self.height/2)
         self.new_width = int(self.width/self.scale)
         self.new_height = int(self.height/self.scale)
 
+    def verify_field(self, min_fraction=0.3):
+        """Checks that the green border of the smartphone window is still at the known location
+
+        Args:
+            min_fraction (float, optional): minimal fraction of green pixels on the border
+
+        Returns:
+            bool: True if the window is at the known location
+        """
+        if self.width == 0:
+            return False
+        return self.check_border(self.backend.grab((self.x, self.y, self.width, self.height)), min_fraction)
+
+    @staticmethod
+    def check_border(image, min_fraction=0.3):
+        """Checks that the outermost pixels of a screenshot of the window are green
+
+        Args:
+            image ([BGR-image]): screenshot of the smartphone window
+            min_fraction (float, optional): minimal fraction of green pixels on every side
+
+        Returns:
+            bool: True if enough pixels on every side are green
+        """
+        for side in [image[0], image[-1], image[:, 0], image[:, -1]]:
+            mask = cv2.inRange(cv2.cvtColor(side[None], cv2.COLOR_BGR2HSV), LOWER_GREEN, UPPER_GREEN)
+            if np.count_nonzero(mask) < min_fraction*mask.size:
+                return False
+        return True
+
     def get_screenshot(self):
         """Captures a screenshot
 
         Returns:
-            RGB-image: screenshot of the smartphone window
+            BGR-image: screenshot of the smartphone window
         """
         if self.width == 0:
-            image = pyautogui.screenshot()
-        else:
-            image = pyautogui.screenshot(region=(self.x, self.y, self.width, self.height))
-        image = np.array(image)
-        if self.width == 0:
-            self.find_field(image)
-            if self.width != 0:
-                image = image[self.y:self.y+self.height, self.x:self.x+self.width]
-            else:
+            image = self.backend.grab()
+            with span('screen.find_field'):
+                self.find_field(image)
+            if self.width == 0:
                 return None
-        field = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-        return field
+            return image[self.y:self.y+self.height, self.x:self.x+self.width]
+        with span('screen.grab'):
+            image = self.backend.grab((self.x, self.y, self.width, self.height))
+        now = time.time()
+        if now-self.last_check >= self.recheck_interval:
+            self.last_check = now
+            if not self.check_border(image):
+                # the window has moved or was closed, search it again
+                self.width = 0
+                return self.get_screenshot()
+        return image
 
-    def get_image(self):
+    def get_image(self, proc_scale=1.0, workspace=None):
         """Capture a image of the smartphone window.
         If no window is found, it waits 1s and retries
 
+        Args:
+            proc_scale (float, optional): resolution relative to the full (750 px high) image
+            workspace (Workspace, optional): workspace of the frame buffer. The image is overwritten
+                by the next call then.
+
         Returns:
             RGB-image: resized screenshot of the smartphone window
         """
@@ -81,5 +242,7 @@ class Screen():
                 print('no app screen found')
                 time.sleep(1)
 
-        img = cv2.resize(img_o, (self.new_width, self.new_height))
+        with span('screen.resize'):
+            size = (int(self.new_width*proc_scale), int(self.new_height*proc_scale))
+            img = cv2.resize(img_o, size, dst=get_buffer(workspace, 'frame', (size[1], size[0], 3)))
         return img
@@ -0,0 +1,305 @@
+import argparse
+import threading
+import time
+import cv2
+import numpy as np
+from actuate import ActuatorBackend
+from workspace import get_buffer
+
+LEVEL_14 = {
+    'width': 422,
+    'height': 750,
+    'start': (3, 2),
+    'gates': {  # cell: (incoming side, [straight exit, side exit])
+        (3, 2): ('up', ['down', 'left']),
+        (3, 1): ('right', ['left', 'up']),
+        (2, 1): ('down', ['up', 'left']),
+        (1, 1): ('down', ['up', 'left']),
+        (4, 2): ('up', ['down', 'right']),
+        (5, 2): ('up', ['down', 'left']),
+        (5, 1): ('right', ['left', 'up']),
+        (4, 3): ('left', ['right', 'up']),
+        (3, 3): ('down', ['up', 'right']),
+        (2, 3): ('down', ['up', 'right']),
+    },
+    'stations': {
+        (3, 0): 'red', (2, 0): 'green', (0, 1): 'blue', (1, 0): 'yellow', (6, 2): 'violet', (5, 0): 'white',
+        (4, 1): 'black', (4, 4): 'red-blue', (3, 4): 'yellow-violet', (1, 3): 'green-violet', (2, 4): 'blue-black'
+    }
+}
+
+OFFSETS = {'up': (-1, 0), 'down': (1, 0), 'left': (0, -1), 'right': (0, 1)}
+HUES = {'red': 165, 'green': 60, 'blue': 100, 'yellow': 25, 'violet': 145}
+BACKGROUND = (60, 140, 60)
+TRACK = (20, 20, 20)
+
+
+def cell_center(cell):
+    """Returns the pixel center of a (row, column) cell of the 7x5 grid
+    """
+    return 50+cell[1]*80, 75+cell[0]*100
+
+
+def part_color(name):
+    if name == 'white':
+        return (240, 240, 240)
+    if name == 'black':
+        return (20, 20, 20)
+    return tuple(int(c) for c in cv2.cvtColor(np.uint8([[[HUES[name], 220, 230]]]), cv2.COLOR_HSV2BGR)[0, 0])
+
+
+def fill_color(img, x0, y0, x1, y1, name):
+    """Fills a rectangle with a one or two colored (e.g. 'red-blue') name
+    """
+    parts = name.split('-')
+    if len(parts) == 1:
+        img[y0:y1, x0:x1] = part_color(parts[0])
+    else:
+        y_mid = (y0+y1)//2
+        img[y0:y_mid, x0:x1] = part_color(parts[0])
+        img[y_mid:y1, x0:x1] = part_color(parts[1])
+
+
+class Simulator():
+    """Headless closed-loop simulation of a Train of Thought level.
+    Renders synthetic frames with stations, gates, tracks and trains and
+    takes the gate clicks of the game. It replaces both the Screen and the
+    click backend of Game, so the detection, planning and click stack can be measured
+    without the phone and faster than real time: every get_image advances
+    the simulation time by frame_dt, independent of the wall time.
+    """
+
+    def __init__(self, level=LEVEL_14, n_trains=4, speed=60, spawn_interval=2.0, frame_dt=1/30, seed=0, click_loss=0.0):
+        """
+        Args:
+            level (dict, optional): layout with width, height, start cell, gates and stations
+            n_trains (int, optional): maximal number of trains on the tracks at the same time
+            speed (float, optional): train speed in pixels per second
+            spawn_interval (float, optional): minimal time between two new trains in seconds
+            frame_dt (float, optional): simulation time per frame in seconds, None to follow the wall time
+            seed (int, optional): seed of the gate states and the train colors
+            click_loss (float, optional): probability that a click does not switch its gate
+        """
+        self.level = level
+        self.n_trains = n_trains
+        self.speed = speed
+        self.spawn_interval = spawn_interval
+        self.frame_dt = frame_dt
+        self.click_loss = click_loss
+        self.random = np.random.default_rng(seed)
+        self.colors = sorted(set(level['stations'].values()))
+        self.states = {cell: exits[self.random.integers(len(exits))] for cell, (_, exits) in level['gates'].items()}
+        self.trains = []
+        self.time = 0.0
+        # like after the countdown of the game, the first frame has no trains
+        self.last_spawn = 0.0
+        self.last_wall = None
+        self.deliveries = 0
+        self.misroutes = 0
+        self.n_frames = 0
+        self.n_clicks = 0
+        self.n_lost = 0
+        self.lock = threading.Lock()
+
+        # Screen interface, the frame is the whole (unscaled) field
+        self.x = 0
+        self.y = 0
+        self.scale = 1.0
+
+        self.background = np.full((level['height'], level['width'], 3), BACKGROUND, np.uint8)
+        start_x, start_y = cell_center(level['start'])
+        cv2.line(self.background, (start_x, 0), (start_x, start_y), TRACK, 8)
+        for cell, (_, exits) in level['gates'].items():
+            for side in exits:
+                cv2.line(self.background, cell_center(cell), cell_center(self.neighbour(cell, side)), TRACK, 8)
+
+    @staticmethod
+    def neighbour(cell, side):
+        return cell[0]+OFFSETS[side][0], cell[1]+OFFSETS[side][1]
+
+    def clock(self):
+        """Returns the simulation time in seconds
+        """
+        return self.time
+
+    def spawn(self):
+        """Adds a train at the top of the start column if the entry is clear
+        """
+        if len(self.trains) >= self.n_trains or self.time-self.last_spawn < self.spawn_interval:
+            return
+        start_x, _ = cell_center(self.level['start'])
+        if any(abs(train['x']-start_x) < 1 and train['y'] < 60 for train in self.trains):
+            return
+        self.trains.append({'x': float(start_x), 'y': 15.0, 'target': self.level['start'],
+                            'color': self.colors[self.random.integers(len(self.colors))]})
+        self.last_spawn = self.time
+
+    def step(self, dt):
+        """Moves the trains along the tracks
+
+        Args:
+            dt (float): simulation time step in seconds
+        """
+        self.time += dt
+        self.spawn()
+        trains = []
+        for train in self.trains:
+            distance = self.speed*dt
+            while True:
+                target_x, target_y = cell_center(train['target'])
+                remaining = abs(target_x-train['x'])+abs(target_y-train['y'])
+                if remaining > distance:
+                    train['x'] += np.sign(target_x-train['x'])*distance
+                    train['y'] += np.sign(target_y-train['y'])*distance
+                    trains.append(train)
+                    break
+                train['x'], train['y'] = float(target_x), float(target_y)
+                distance -= remaining
+                cell = train['target']
+                if cell in self.level['stations']:
+                    if self.level['stations'][cell] == train['color']:
+                        self.deliveries += 1
+                    else:
+                        self.misroutes += 1
+                    break
+                train['target'] = self.neighbour(cell, self.states[cell])
+        self.trains = trains
+
+    def render(self):
+        """Draws the current state
+
+        Returns:
+            BGR-image: frame of the level
+        """
+        img = self.background.copy()
+        for cell, (incoming, _) in self.level['gates'].items():
+            x, y = cell_center(cell)
+            cv2.circle(img, (x, y), 28, (150, 150, 150), -1)
+            cv2.circle(img, (x, y), 28, (90, 90, 90), 3)
+            # the gate shows a straight piece or a curve from the incoming side to the active exit
+            for side in (incoming, self.states[cell]):
+                d_row, d_col = OFFSETS[side]
+                cv2.line(img, (x, y), (x+d_col*28, y+d_row*28), TRACK, 8)
+        for cell, name in self.level['stations'].items():
+            x, y = cell_center(cell)
+            cv2.rectangle(img, (x-27, y-27), (x+27, y+27), (255, 255, 255), 3)
+            fill_color(img, x-25, y-25, x+26, y+26, name)
+        for train in self.trains:
+            x, y = int(train['x']), int(train['y'])
+            cv2.rectangle(img, (x-15, y-15), (x+15, y+15), (255, 255, 255), 2)
+            fill_color(img, x-13, y-13, x+14, y+14, train['color'])
+        return img
+
+    def get_image(self, proc_scale=1.0, workspace=None):
+        """Advances the simulation by one frame and renders it, see Screen.get_image
+
+        Args:
+            proc_scale (float, optional): resolution relative to the 750 px high image
+            workspace (Workspace, optional): workspace of the frame buffer
+
+        Returns:
+            BGR-image: frame of the level
+        """
+        with self.lock:
+            if self.frame_dt is None:
+                now = time.perf_counter()
+                dt = 0 if self.last_wall is None else now-self.last_wall
+                self.last_wall = now
+            else:
+                dt = self.frame_dt
+            self.step(dt)
+            self.n_frames += 1
+            img = self.render()
+        if proc_scale != 1.0:
+            size = (int(img.shape[1]*proc_scale), int(img.shape[0]*proc_scale))
+            img = cv2.resize(img, size, dst=get_buffer(workspace, 'frame', (size[1], size[0], 3)))
+        return img
+
+    def ground_truth(self):
+        """Returns the trains of the last frame
+
+        Returns:
+            list: list of trains with position and color
+        """
+        with self.lock:
+            return [{'x': int(train['x']), 'y': int(train['y']), 'color': train['color']} for train in self.trains]
+
+    def labels(self):
+        """Returns the labels of the last frame for a corpus, see corpus.py
+
+        Returns:
+            dict: trains, stations and gates with position (and color)
+        """
+        stations = [dict(zip(('x', 'y'), cell_center(cell)), color=name) for cell, name in self.level['stations'].items()]
+        gates = [dict(zip(('x', 'y'), cell_center(cell))) for cell in self.level['gates']]
+        return {'trains': self.ground_truth(), 'stations': stations, 'gates': gates}
+
+    def click(self, x, y):
+        """Toggles the gate at a position
+
+        Args:
+            x (float): x position in pixels
+            y (float): y position in pixels
+        """
+        with self.lock:
+            for cell, (_, exits) in self.level['gates'].items():
+                gate_x, gate_y = cell_center(cell)
+                if (gate_x-x)**2+(gate_y-y)**2 <= 30**2:
+                    self.n_clicks += 1
+                    if self.click_loss > 0 and self.random.random() < self.click_loss:
+                        self.n_lost += 1
+                        return
+                    self.states[cell] = exits[1-exits.index(self.states[cell])]
+                    return
+
+
+class SimActuator(ActuatorBackend):
+    """Click backend that sends the clicks of Game to a Simulator
+    """
+    name = 'sim'
+
+    def __init__(self, simulator):
+        super().__init__()
+        self.simulator = simulator
+
+    def _click(self, positions):
+        for position in positions:
+            self.simulator.click(*position)
+
+
+if __name__ == '__main__':
+    from main import Game
+    from pipeline import Pipeline
+
+    parser = argparse.ArgumentParser(description='Plays a simulated level and reports the throughput')
+    parser.add_argument('--trains', type=int, default=4, help='maximal number of trains at the same time')
+    parser.add_argument('--speed', type=float, default=60, help='train speed in pixels per second')
+    parser.add_argument('--spawn', type=float, default=2.0, help='minimal time between two new trains in seconds')
+    parser.add_argument('--duration', type=float, default=160, help='simulation time in seconds')
+    parser.add_argument('--fps', type=float, default=30, help='simulated frames per second, 0 to follow the wall time')
+    parser.add_argument('--rate', type=float, default=0, help='target frames per second of the game loop, 0 to run as fast as possible')
+    parser.add_argument('--scale', type=float, default=1.0, help='resolution of the train detection, e.g. 0.5')
+    parser.add_argument('--pipelined', action='store_true', help='run capture, detection and clicks in separate stages')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--click-loss', type=float, default=0.0, help='probability that a click does not switch its gate')
+    parser.add_argument('--no-readback', action='store_true', help='assume that every click switches its gate')
+    parser.add_argument('--log', default='sim.ndjson', help='run log')
+    args = parser.parse_args()
+
+    simulator = Simulator(n_trains=args.trains, speed=args.speed, spawn_interval=args.spawn,
+                          frame_dt=1/args.fps if args.fps > 0 else None, seed=args.seed,
+                          click_loss=args.click_loss)
+    game = Game(log=args.log, proc_scale=args.scale, cache=None,
+                screen=simulator, actuator=SimActuator(simulator), clock=simulator.clock,
+                readback=not args.no_readback)
+    start_time = time.perf_counter()
+    if args.pipelined:
+        Pipeline(game).run(args.duration)
+    else:
+        game.run(args.duration, args.rate or None)
+    wall_time = time.perf_counter()-start_time
+    print('simulated: %.1f s  wall: %.1f s  speedup: %.1fx' % (simulator.time, wall_time, simulator.time/wall_time))
+    print('frames: %d  fps: %.1f' % (simulator.n_frames, simulator.n_frames/wall_time))
+    print('clicks: %d  lost: %d' % (simulator.n_clicks, simulator.n_lost))
+    print('deliveries: %d  misroutes: %d  deliveries/min: %.1f' % (
+        simulator.deliveries, simulator.misroutes, simulator.deliveries/simulator.time*60))
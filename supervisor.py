@@ -0,0 +1,212 @@
+import argparse
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from collections import Counter
+from actuate import ActuatorBackend, make_actuator
+
+
+class QueueActuator(ActuatorBackend):
+    """Click backend of a worker process.
+    The clicks are sent to the actuator of the supervisor, the latency is the time to queue them.
+    """
+    name = 'queue'
+
+    def __init__(self, index, clicks):
+        """
+        Args:
+            index (int): index of the window
+            clicks (Queue): click queue of the supervisor
+        """
+        super().__init__()
+        self.index = index
+        self.clicks = clicks
+
+    def _click(self, positions):
+        self.clicks.put((self.index, positions, time.time()))
+
+
+def run_worker(index, window, clicks, inbox, results, options):
+    """Plays one window. Runs in its own process with its own Grid, tracker and planner.
+
+    Args:
+        index (int): index of the window
+        window (list): x, y, width and height of the window on the screen
+        clicks (Queue): click queue of the supervisor
+        inbox (Queue): clicks for the simulated window, None for a real window
+        results (Queue): queue for the frame count of the worker
+        options (dict): duration, rate, proc_scale, cache and log
+    """
+    import cv2
+    from main import Game
+    from screen import Screen
+
+    # the windows are spread over the cores, so every worker detects on a single thread
+    cv2.setNumThreads(1)
+    if inbox is not None:
+        from simulator import Simulator
+        screen = Simulator(seed=index, frame_dt=None)
+        screen.x, screen.y = window[0], window[1]
+
+        def forward():
+            while True:
+                position = inbox.get()
+                if position is None:
+                    break
+                screen.click(position[0]-screen.x, position[1]-screen.y)
+        threading.Thread(target=forward, daemon=True).start()
+        clock = screen.clock
+    else:
+        screen = Screen(window=window)
+        clock = None
+
+    cache = None if options['cache'] is None else os.path.join(options['cache'], str(index))
+    game = Game(log=options['log'] % index, proc_scale=options['proc_scale'], cache=cache,
+                screen=screen, actuator=QueueActuator(index, clicks), clock=clock)
+    start_time = time.perf_counter()
+    n_frames = game.run(options['duration'], options['rate'])
+    result = {'index': index, 'frames': n_frames, 'time': time.perf_counter()-start_time}
+    if inbox is not None:
+        result['deliveries'] = screen.deliveries
+        result['misroutes'] = screen.misroutes
+    results.put(result)
+
+
+class Actuator():
+    """Issues the clicks of all workers one after the other, because there is only one pointer
+    """
+
+    def __init__(self, click):
+        """
+        Args:
+            click (callable): click(index, positions) clicks a batch of positions of a window
+        """
+        self.click = click
+        self.n_clicks = Counter()
+        self.latencies = []
+
+    def run(self, clicks, workers):
+        """Issues clicks until all workers have finished
+
+        Args:
+            clicks (Queue): click queue of the workers
+            workers (list): worker processes
+        """
+        while True:
+            try:
+                index, positions, issue_time = clicks.get(timeout=0.1)
+            except queue.Empty:
+                if not any(worker.is_alive() for worker in workers):
+                    break
+                continue
+            self.click(index, positions)
+            self.n_clicks[index] += len(positions)
+            self.latencies.append(time.time()-issue_time)
+
+
+def find_windows():
+    """Finds all smartphone windows on the screen
+
+    Returns:
+        list: rects (x, y, width, height) of the windows
+    """
+    from capture import make_backend
+    from screen import Screen
+
+    backend = make_backend()
+    try:
+        return Screen.find_windows(backend.grab())
+    finally:
+        backend.close()
+
+
+def supervise(duration=160, proc_scale=1.0, max_windows=None, simulate=0, cache='.calibration', log='log-%d.ndjson', rate=30,
+              actuator='auto'):
+    """Plays every game window on the screen with one worker process per window
+
+    Args:
+        duration (int, optional): run time in seconds
+        proc_scale (float, optional): resolution of the train detection, see Game
+        max_windows (int, optional): maximal number of windows to play
+        simulate (int, optional): number of simulated windows to play instead of the screen
+        cache (string, optional): directory of the calibration cache, a subdirectory is used per window
+        log (string, optional): run log per window, %d is replaced by the window index
+        rate (float, optional): target frames per second of every worker, None to run as fast as possible
+        actuator (string, optional): desktop click backend of the supervisor, see actuate.make_actuator
+    """
+    context = multiprocessing.get_context('spawn')
+    if simulate > 0:
+        windows = [[idx*1000, 0, 422, 750] for idx in range(simulate)]
+        cache = None
+    else:
+        windows = find_windows()
+    windows = windows[:max_windows]
+    if len(windows) == 0:
+        print('no app screen found')
+        return
+    print('windows:', windows)
+
+    clicks = context.Queue()
+    results = context.Queue()
+    inboxes = [context.Queue() if simulate > 0 else None for _ in windows]
+    options = {'duration': duration, 'rate': rate, 'proc_scale': proc_scale, 'cache': cache, 'log': log}
+    workers = [context.Process(target=run_worker, args=(idx, window, clicks, inboxes[idx], results, options))
+               for idx, window in enumerate(windows)]
+    for worker in workers:
+        worker.start()
+
+    backend = None
+    if simulate > 0:
+        def click(index, positions):
+            for position in positions:
+                inboxes[index].put(position)
+    else:
+        backend = make_actuator(actuator)
+
+        def click(index, positions):
+            backend.click(positions)
+    actuator = Actuator(click)
+    actuator.run(clicks, workers)
+    for inbox in inboxes:
+        if inbox is not None:
+            inbox.put(None)
+    for worker in workers:
+        worker.join()
+
+    total_fps = 0
+    for _ in workers:
+        try:
+            result = results.get(timeout=1)
+        except queue.Empty:
+            break
+        fps = result['frames']/result['time']
+        total_fps += fps
+        line = 'window %d: frames %d  fps %.1f  clicks %d' % (result['index'], result['frames'], fps, actuator.n_clicks[result['index']])
+        if 'deliveries' in result:
+            line += '  deliveries %d  misroutes %d' % (result['deliveries'], result['misroutes'])
+        print(line)
+    print('total fps: %.1f' % total_fps)
+    if len(actuator.latencies) > 0:
+        print('click queue latency [ms]: mean %.1f max %.1f' % (
+            sum(actuator.latencies)/len(actuator.latencies)*1000, max(actuator.latencies)*1000))
+    if backend is not None:
+        stats = backend.stats()
+        print('click batch latency [ms] (%s, %d batches): mean %.2f p95 %.2f max %.2f' % (
+            stats['backend'], stats['batches'], stats['mean']*1000, stats['p95']*1000, stats['max']*1000))
+        backend.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Plays every Train of Thought window on the screen, one process per window')
+    parser.add_argument('--duration', type=float, default=160, help='run time in seconds')
+    parser.add_argument('--scale', type=float, default=1.0, help='resolution of the train detection, e.g. 0.5')
+    parser.add_argument('--rate', type=float, default=30, help='target frames per second per window, 0 to run as fast as possible')
+    parser.add_argument('--windows', type=int, help='maximal number of windows')
+    parser.add_argument('--simulate', type=int, default=0, metavar='N', help='play N simulated windows instead of the screen')
+    parser.add_argument('--no-cache', action='store_true', help='ignore the cached window locations and track graphs')
+    parser.add_argument('--actuator', default='auto', choices=['auto', 'xtest', 'pynput'], help='desktop click backend')
+    args = parser.parse_args()
+    supervise(args.duration, args.scale, args.windows, args.simulate, None if args.no_cache else '.calibration', rate=args.rate or None,
+              actuator=args.actuator)
@@ -0,0 +1,146 @@
+import time
+import numpy as np
+from instrument import span
+from util import find_candidates, classify_candidates
+from workspace import Workspace
+
+
+class Tracker():
+    """Tracks trains across frames.
+    Every train gets a persistent id. Detections are associated with the
+    predicted positions of the known trains (nearest neighbour) and only
+    trains that cannot be associated with enough confidence are classified again.
+    """
+
+    def __init__(self, max_distance=25, min_confidence=0.5, max_missed=3, smoothing=0.5, background=None, workspace=None):
+        """
+        Args:
+            max_distance (int, optional): maximal distance in pixels between prediction and detection
+            min_confidence (float, optional): association confidence below which a train is classified again
+            max_missed (int, optional): number of frames a train may be missing before it is dropped
+            smoothing (float, optional): weight of the new measurement in the velocity estimate
+            background (Background, optional): background model of the level. If None, trains
+                are found by thresholding the whole frame.
+            workspace (Workspace, optional): buffers of the detection, a new workspace if None
+        """
+        self.background = background
+        self.workspace = workspace if workspace is not None else Workspace()
+        # white trains are checked for track lines, not needed for candidates of the background model
+        self.reject_track = background is None
+        self.max_distance = max_distance
+        self.min_confidence = min_confidence
+        self.max_missed = max_missed
+        self.smoothing = smoothing
+        self.tracks = []
+        self.next_id = 0
+        self.last_time = None
+        self.n_detected = 0
+        self.n_classified = 0
+
+    def predict(self, dt):
+        """Predicts the positions of all tracks
+
+        Args:
+            dt (float): time since the last frame in seconds
+
+        Returns:
+            array: predicted positions (n, 2)
+        """
+        if len(self.tracks) == 0:
+            return np.zeros((0, 2))
+        return np.array([[track['x']+track['vx']*dt, track['y']+track['vy']*dt] for track in self.tracks])
+
+    def associate(self, positions, predictions):
+        """Greedy nearest neighbour association
+
+        Args:
+            positions (array): positions of the candidates (n, 2)
+            predictions (array): predicted positions of the tracks
+
+        Returns:
+            dict: index of candidate -> (index of track, confidence)
+        """
+        matches = {}
+        if len(positions) == 0 or len(predictions) == 0:
+            return matches
+        distances = np.linalg.norm(positions[:, None, :]-predictions[None, :, :], axis=2)
+        used_tracks = set()
+        for flat in np.argsort(distances, axis=None):
+            c_idx, t_idx = np.unravel_index(flat, distances.shape)
+            if distances[c_idx, t_idx] > self.max_distance:
+                break
+            if c_idx in matches or t_idx in used_tracks:
+                continue
+            matches[c_idx] = (t_idx, 1-distances[c_idx, t_idx]/self.max_distance)
+            used_tracks.add(t_idx)
+        return matches
+
+    def update(self, img, timestamp=None, proc_scale=1.0):
+        """Detects the trains of a frame and updates the tracks.
+        Positions and velocities are in the full (750 px high) image.
+
+        Args:
+            img (RGB-image): screenshot of the game
+            timestamp (float, optional): capture time in seconds
+            proc_scale (float, optional): resolution of img relative to the full image
+
+        Returns:
+            list: list of trains with id, position, velocity and color
+            int: number of stations found
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        dt = 0 if self.last_time is None else timestamp-self.last_time
+        self.last_time = timestamp
+
+        if self.background is not None:
+            candidates, n_stations, contours = self.background.find_candidates(img, self.workspace)
+        else:
+            candidates, n_stations, contours = find_candidates(img, stations=False, workspace=self.workspace)
+        positions = np.array([[candidate['x'], candidate['y']] for candidate in candidates]).reshape(-1, 2)/proc_scale
+        with span('tracker.associate'):
+            matches = self.associate(positions, self.predict(dt))
+
+        unknown = [idx for idx in range(len(candidates))
+                   if idx not in matches or matches[idx][1] < self.min_confidence or self.tracks[matches[idx][0]]['color'] is None]
+        color_names = classify_candidates(img, [candidates[idx] for idx in unknown], contours, proc_scale,
+                                          reject_track=self.reject_track, workspace=self.workspace)
+        self.n_detected += len(candidates)
+        self.n_classified += len(unknown)
+        colors = dict(zip(unknown, color_names))
+
+        tracks = []
+        for idx, (c_x, c_y) in enumerate(positions):
+            if idx in colors and colors[idx] is None:
+                continue
+            if idx in matches:
+                track = self.tracks[matches[idx][0]]
+                if dt > 0:
+                    alpha = self.smoothing
+                    track['vx'] = (1-alpha)*track['vx']+alpha*(c_x-track['x'])/dt
+                    track['vy'] = (1-alpha)*track['vy']+alpha*(c_y-track['y'])/dt
+                track['confidence'] = matches[idx][1]
+            else:
+                track = {'id': self.next_id, 'vx': 0.0, 'vy': 0.0, 'confidence': 0.0, 'color': None}
+                self.next_id += 1
+            if idx in colors:
+                track['color'] = colors[idx]
+            track['x'] = c_x
+            track['y'] = c_y
+            track['missed'] = 0
+            tracks.append(track)
+
+        matched_tracks = set(t_idx for t_idx, _ in matches.values())
+        for t_idx, track in enumerate(self.tracks):
+            if t_idx in matched_tracks:
+                continue
+            track['missed'] += 1
+            if track['missed'] <= self.max_missed:
+                track['x'] += track['vx']*dt
+                track['y'] += track['vy']*dt
+                tracks.append(track)
+        self.tracks = tracks
+
+        trains = [{'id': track['id'], 'x': int(track['x']), 'y': int(track['y']), 'vx': track['vx'], 'vy': track['vy'], 'color': track['color']}
+                  for track in self.tracks if track['missed'] == 0]
+        return trains, n_stations
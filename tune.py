@@ -0,0 +1,286 @@
+import argparse
+import time
+import cv2
+import numpy as np
+import background
+import grid
+import screen
+import util
+from corpus import read_corpus
+
+# stages of the evaluation: trains by thresholding the frame, trains by the background
+# model (the default detector of the game), stations, gates and the window search
+CLASSIFIED = ('trains', 'background', 'stations')
+
+# swept parameters: name -> (module, attribute, values, conversion of a value to the attribute,
+# stages whose CPU time the parameter changes)
+PARAMETERS = {
+    'threshold': (util, 'ITEM_THRESHOLD', [150, 165, 180, 195, 210], None, ('trains', 'stations')),
+    'min_train_area': (util, 'MIN_TRAIN_AREA', [0.0005, 0.001, 0.0015, 0.002], None, CLASSIFIED),
+    'min_station_area': (util, 'MIN_STATION_AREA', [0.004, 0.005, 0.006], None, CLASSIFIED),
+    'hue_margin': (util, 'HUE_LUT', [0, 3, 6], util.make_hue_lut, CLASSIFIED),
+    'gray_saturation': (util, 'GRAY_SATURATION', [30, 50, 70], None, CLASSIFIED),
+    'white_value': (util, 'WHITE_VALUE', [180, 200, 220], None, CLASSIFIED),
+    'red_white_saturation_std': (util, 'RED_WHITE_SATURATION_STD', [85, 95, 105], None, CLASSIFIED),
+    'red_white_value_std': (util, 'RED_WHITE_VALUE_STD', [30, 40, 50], None, CLASSIFIED),
+    'two_color_ratio': (util, 'TWO_COLOR_RATIO', [3, 4, 6], None, CLASSIFIED),
+    'black_value_std': (util, 'BLACK_VALUE_STD', [45, 55, 65], None, CLASSIFIED),
+    'track_canny': (util, 'TRACK_CANNY', [(30, 100), (50, 150), (80, 200)], None, ('trains',)),
+    'track_votes': (util, 'TRACK_VOTES', [30, 40, 50], None, ('trains',)),
+    'track_min_length': (util, 'TRACK_MIN_LENGTH', [20, 30, 40], None, ('trains',)),
+    'bright': (background, 'BRIGHT', [150, 165, 180, 195, 210], None, ('background',)),
+    'change_threshold': (background, 'CHANGE_THRESHOLD', [25, 30, 40, 50, 60], None, ('background',)),
+    'gate_canny': (grid, 'GATE_CANNY', [30, 50, 80], None, ('gates',)),
+    'gate_votes': (grid, 'GATE_VOTES', [30, 40, 50], None, ('gates',)),
+    'gate_radii': (grid, 'GATE_RADII', [(18, 35), (22, 35), (22, 30)], None, ('gates',)),
+    'green_lower': (screen, 'LOWER_GREEN', [(40, 80, 40), (50, 100, 50), (55, 110, 60)], np.array, ('window',)),
+    'green_upper': (screen, 'UPPER_GREEN', [(70, 130, 110), (80, 140, 120), (90, 160, 140)], np.array, ('window',)),
+}
+
+# stages whose CPU time the detection resolution changes
+SCALE_STAGES = ('trains', 'background')
+
+# maximal distance in pixels (750 px high image) of a detection from its label
+MAX_DISTANCE = {'trains': 15, 'stations': 20, 'gates': 10}
+
+# minimal intersection over union of a found window with its label
+MIN_WINDOW_IOU = 0.9
+
+
+def match(found, labels, max_distance):
+    """Matches detections to labels, nearest pairs first
+
+    Args:
+        found (list): detections with x and y
+        labels (list): labels with x and y
+        max_distance (float): maximal distance of a pair in pixels
+
+    Returns:
+        list: (detection, label) pairs
+    """
+    if len(found) == 0 or len(labels) == 0:
+        return []
+    positions = np.array([[item['x'], item['y']] for item in found], dtype=float)
+    targets = np.array([[label['x'], label['y']] for label in labels], dtype=float)
+    distances = np.linalg.norm(positions[:, None]-targets[None], axis=2)
+    pairs = []
+    for d_idx, l_idx in zip(*np.unravel_index(np.argsort(distances, axis=None), distances.shape)):
+        if distances[d_idx, l_idx] > max_distance:
+            break
+        if any(d_idx == d or l_idx == l for d, l in pairs):
+            continue
+        pairs.append((d_idx, l_idx))
+    return [(found[d_idx], labels[l_idx]) for d_idx, l_idx in pairs]
+
+
+def iou(rect, other):
+    """Returns the intersection over union of two rects (x, y, width, height)
+    """
+    width = min(rect[0]+rect[2], other[0]+other[2])-max(rect[0], other[0])
+    height = min(rect[1]+rect[3], other[1]+other[3])-max(rect[1], other[1])
+    if width <= 0 or height <= 0:
+        return 0.0
+    intersection = width*height
+    return intersection/(rect[2]*rect[3]+other[2]*other[3]-intersection)
+
+
+def count_trains(counts, prefix, trains, labels):
+    """Adds the matches of the detected trains of a frame to the counts
+
+    Args:
+        counts (dict): counts of the evaluation
+        prefix (string): 'trains' or 'background'
+        trains (list): detected trains with x, y and color
+        labels (list): labeled trains
+    """
+    pairs = match(trains, labels, MAX_DISTANCE['trains'])
+    counts[prefix] += len(labels)
+    counts[prefix+'_found'] += len(trains)
+    counts[prefix+'_matched'] += len(pairs)
+    counts[prefix+'_colored'] += sum(train['color'] == label['color'] for train, label in pairs)
+
+
+def calibrate(corpus):
+    """Calibrates the grid for the background model on the first frame with train labels
+
+    Args:
+        corpus (list): (frame, labels) pairs, see corpus.read_corpus
+
+    Returns:
+        tuple: calibration frame and grid, None if no frame has train labels
+    """
+    for img, labels in corpus:
+        if 'trains' in labels:
+            return img, grid.Grid(img)
+    return None
+
+
+def evaluate(corpus, proc_scale=1.0, calibration=None):
+    """Runs the detection on a corpus and compares it with the labels.
+    The background model starts from the calibration frame and is updated
+    frame by frame, as in the game.
+
+    Args:
+        corpus (list): (frame, labels) pairs, see corpus.read_corpus
+        proc_scale (float, optional): resolution of the train detection
+        calibration (tuple, optional): calibration frame and grid, see calibrate.
+            Calibrated on the corpus if None.
+
+    Returns:
+        dict: precision, recall and color accuracy of the trains found by thresholding and by the
+            background model, recall and color accuracy of stations, precision and recall of gates,
+            window accuracy and CPU milliseconds per frame of every stage
+    """
+    counts = {key: 0 for key in ['trains', 'trains_found', 'trains_matched', 'trains_colored',
+                                 'background', 'background_found', 'background_matched', 'background_colored',
+                                 'stations', 'stations_matched', 'stations_colored',
+                                 'gates', 'gates_found', 'gates_matched', 'windows', 'windows_found']}
+    cpu = {'trains': [], 'background': [], 'stations': [], 'gates': [], 'window': []}
+    if calibration is None:
+        calibration = calibrate(corpus)
+    model = background.Background(*calibration) if calibration is not None else None
+    for img, labels in corpus:
+        if 'trains' in labels:
+            small = img if proc_scale == 1.0 else cv2.resize(img, None, fx=proc_scale, fy=proc_scale)
+            start_time = time.process_time()
+            trains, _ = util.find_items(small, stations=False, proc_scale=proc_scale)
+            cpu['trains'].append(time.process_time()-start_time)
+            count_trains(counts, 'trains', trains, labels['trains'])
+
+            start_time = time.process_time()
+            candidates, _, contours = model.find_candidates(small)
+            color_names = util.classify_candidates(small, candidates, contours, proc_scale, reject_track=False)
+            cpu['background'].append(time.process_time()-start_time)
+            trains = [{'x': candidate['x']/proc_scale, 'y': candidate['y']/proc_scale, 'color': color_name}
+                      for candidate, color_name in zip(candidates, color_names) if color_name is not None]
+            count_trains(counts, 'background', trains, labels['trains'])
+        if 'stations' in labels:
+            start_time = time.process_time()
+            stations, _ = util.find_items(img, stations=True)
+            cpu['stations'].append(time.process_time()-start_time)
+            pairs = match(stations, labels['stations'], MAX_DISTANCE['stations'])
+            counts['stations'] += len(labels['stations'])
+            counts['stations_matched'] += len(pairs)
+            counts['stations_colored'] += sum(station['color'] == label['color'] for station, label in pairs)
+        if 'gates' in labels:
+            start_time = time.process_time()
+            gates = grid.Grid.find_gates(img)
+            cpu['gates'].append(time.process_time()-start_time)
+            pairs = match(gates, labels['gates'], MAX_DISTANCE['gates'])
+            counts['gates'] += len(labels['gates'])
+            counts['gates_found'] += len(gates)
+            counts['gates_matched'] += len(pairs)
+        if 'window' in labels:
+            start_time = time.process_time()
+            windows = screen.Screen.find_windows(img)
+            cpu['window'].append(time.process_time()-start_time)
+            counts['windows'] += 1
+            counts['windows_found'] += any(iou(window, labels['window']) >= MIN_WINDOW_IOU for window in windows)
+
+    def ratio(numerator, denominator):
+        return counts[numerator]/counts[denominator] if counts[denominator] > 0 else np.nan
+
+    scores = {
+        'train_precision': ratio('trains_matched', 'trains_found'),
+        'train_recall': ratio('trains_matched', 'trains'),
+        'train_color': ratio('trains_colored', 'trains_matched'),
+        'background_precision': ratio('background_matched', 'background_found'),
+        'background_recall': ratio('background_matched', 'background'),
+        'background_color': ratio('background_colored', 'background_matched'),
+        'station_recall': ratio('stations_matched', 'stations'),
+        'station_color': ratio('stations_colored', 'stations_matched'),
+        'gate_precision': ratio('gates_matched', 'gates_found'),
+        'gate_recall': ratio('gates_matched', 'gates'),
+        'window': ratio('windows_found', 'windows'),
+    }
+    for stage, values in cpu.items():
+        scores[stage+'_ms'] = np.mean(values)*1000 if len(values) > 0 else np.nan
+    return scores
+
+
+def override(name, value):
+    """Sets a parameter
+
+    Args:
+        name (string): name in PARAMETERS
+        value: new value, before the conversion
+
+    Returns:
+        previous value of the attribute
+    """
+    module, attribute, _, convert, _ = PARAMETERS[name]
+    previous = getattr(module, attribute)
+    setattr(module, attribute, convert(value) if convert is not None else value)
+    return previous
+
+
+def sweep(corpus, names=None, scales=(1.0, 0.75, 0.5)):
+    """Evaluates the default parameters and every value of every parameter, one parameter at a time.
+    The grid of the background model is calibrated once with the default parameters.
+
+    Args:
+        corpus (list): (frame, labels) pairs, see corpus.read_corpus
+        names (list, optional): names of the swept parameters, all of PARAMETERS if None
+        scales (tuple, optional): resolutions of the train detection
+
+    Returns:
+        list: (name, value, scores), name and value are None for the defaults
+    """
+    calibration = calibrate(corpus)
+    results = [(None, None, evaluate(corpus, calibration=calibration))]
+    for scale in scales:
+        if scale != 1.0:
+            results.append(('scale', scale, evaluate(corpus, scale, calibration)))
+    for name in names if names is not None else PARAMETERS:
+        for value in PARAMETERS[name][2]:
+            previous = override(name, value)
+            try:
+                results.append((name, value, evaluate(corpus, calibration=calibration)))
+            finally:
+                module, attribute = PARAMETERS[name][:2]
+                setattr(module, attribute, previous)
+    return results
+
+
+def report(results, tolerance=0.005, min_saving=0.05):
+    """Prints the scores of every setting and the cheapest value of every parameter
+    that detects as well as the defaults. The cost of a value is the CPU time
+    of the stages that the parameter changes.
+
+    Args:
+        results (list): results of sweep
+        tolerance (float, optional): accepted loss of every accuracy score
+        min_saving (float, optional): minimal relative saving of CPU time, smaller savings are timing noise
+    """
+    columns = list(results[0][2])
+    width = max(len(column) for column in columns)+2
+    print('%-26s %12s' % ('parameter', 'value')+''.join('%*s' % (width, column) for column in columns))
+    for name, value, scores in results:
+        print('%-26s %12s' % (name or 'default', '' if value is None else value)
+              +''.join('%*.3f' % (width, scores[column]) for column in columns))
+
+    default = results[0][2]
+    accuracy = [column for column in columns if not column.endswith('_ms') and not np.isnan(default[column])]
+    print()
+    print('cheapest values without accuracy loss:')
+    for name in dict.fromkeys(name for name, _, _ in results[1:]):
+        stages = SCALE_STAGES if name == 'scale' else PARAMETERS[name][4]
+        cost = [stage+'_ms' for stage in stages if not np.isnan(default[stage+'_ms'])]
+        default_cost = sum(default[column] for column in cost)
+        candidates = [(sum(scores[column] for column in cost), value) for n, value, scores in results
+                      if n == name and all(scores[column] >= default[column]-tolerance for column in accuracy)]
+        total, value = min(candidates, key=lambda candidate: candidate[0], default=(default_cost, 'default'))
+        if total > (1-min_saving)*default_cost:
+            (total, value) = (default_cost, 'default')
+        print('%-26s %12s  %.2f ms (default %.2f ms)' % (name, value, total, default_cost))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Sweeps the detection parameters over a labeled corpus and reports accuracy and CPU time')
+    parser.add_argument('directory', help='corpus directory, see corpus.py')
+    parser.add_argument('--parameters', nargs='+', choices=list(PARAMETERS), help='swept parameters, all by default')
+    parser.add_argument('--scales', type=float, nargs='+', default=[1.0, 0.75, 0.5], help='resolutions of the train detection')
+    args = parser.parse_args()
+
+    cv2.setNumThreads(1)
+    report(sweep(read_corpus(args.directory), args.parameters, args.scales))
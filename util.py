@@ -1,38 +1,114 @@
 from collections import Counter
 import numpy as np
 import cv2
+from instrument import span
+from workspace import get_buffer, get_zeros
+
+COLOR_NAMES = ['red', 'green', 'blue', 'yellow', 'violet']
+
+# OpenCV hue range (0-179) of every color in COLOR_NAMES
+HUE_BANDS = [(161, 170), (55, 65), (95, 105), (20, 30), (140, 150)]
+
+# detection parameters, see tune.py. They are read at call time, so tune.py can override them.
+# gray value of the white outline of stations and trains
+ITEM_THRESHOLD = 180
+# contour area relative to the image: trains from MIN_TRAIN_AREA, stations from MIN_STATION_AREA
+MIN_TRAIN_AREA = 0.001
+MIN_STATION_AREA = 0.005
+# mean saturation below which an object is white or black, mean value above which it is white
+GRAY_SATURATION = 50
+WHITE_VALUE = 200
+# red-white stations: mean saturation below, saturation spread above and value spread below
+RED_WHITE_SATURATION = 150
+RED_WHITE_SATURATION_STD = 95
+RED_WHITE_VALUE_STD = 40
+# main color ratio below which an object has two colors
+TWO_COLOR_RATIO = 4
+# value spread above which a blue, green or yellow object is mixed with black
+BLACK_VALUE_STD = 55
+# Canny thresholds, minimal votes and line length of the track lines of white trains
+TRACK_CANNY = (50, 150)
+TRACK_VOTES = 40
+TRACK_MIN_LENGTH = 30
+
+
+def make_hue_lut(margin=0):
+    """Builds the lookup table from hue to color
 
-def find_items(img, stations=True):
+    Args:
+        margin (int, optional): hues added on both sides of every band of HUE_BANDS
+
+    Returns:
+        array: maps an OpenCV hue (0-179) to 1 + index in COLOR_NAMES, 0 if the hue belongs to no color
+    """
+    lut = np.zeros(256, dtype=np.uint8)
+    for idx, (low, high) in enumerate(HUE_BANDS):
+        lut[max(low-margin, 0):high+margin] = idx+1
+    return lut
+
+
+HUE_LUT = make_hue_lut()
+
+
+def find_items(img, stations=True, proc_scale=1.0, workspace=None):
     """Finds stations or trains in an iamge
 
     Args:
         img (RGB-image): screenshot of the game
         stations (bool, optional): if True, finds stations. if False, finds trains.
+        proc_scale (float, optional): resolution of img relative to the full (750 px high) image
+        workspace (Workspace, optional): reused buffers of the per-frame images
 
     Returns:
-        list: list of trains or stations
+        list: list of trains or stations, positions in the full image
         int: number of stations found
     """
-    n_stations = 0
+    candidates, n_stations, contours = find_candidates(img, stations, workspace)
+    color_names = classify_candidates(img, candidates, contours, proc_scale, workspace=workspace)
+
     items = []
-    gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+    for candidate, color_name in zip(candidates, color_names):
+        if color_name is None:
+            continue
+        c_x = int(candidate['x']/proc_scale)
+        c_y = int(candidate['y']/proc_scale)
+        if candidate['type'] == 'station':
+            items.append({'x': c_x, 'y': c_y, 'type': 'station', 'color': color_name})
+        else:
+            items.append({'x': c_x, 'y': c_y, 'color': color_name})
+    return items, n_stations
+
+
+def find_candidates(img, stations=True, workspace=None):
+    """Finds the contours of stations or trains in an image without classifying them
+
+    Args:
+        img (RGB-image): screenshot of the game
+        stations (bool, optional): if True, finds stations. if False, finds trains.
+        workspace (Workspace, optional): buffers of the gray and threshold image
+
+    Returns:
+        list: list of candidates with type, position, padding and contour
+        int: number of stations found
+        list: all contours of the image
+    """
+    n_stations = 0
+    candidates = []
     (height, width, _) = img.shape
     size = height*width
-    _, thresh_blurred = cv2.threshold(gray, 180, 255, cv2.THRESH_BINARY)
-
-    contours,_ = cv2.findContours(thresh_blurred, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    with span('find_items.threshold'):
+        gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY, dst=get_buffer(workspace, 'gray', img.shape[:2]))
+        _, thresh_blurred = cv2.threshold(gray, ITEM_THRESHOLD, 255, cv2.THRESH_BINARY,
+                                          dst=get_buffer(workspace, 'thresh', img.shape[:2]))
 
-    mask_b = np.zeros(img.shape[:2], dtype='uint8')
-    cv2.fillPoly(mask_b, contours, 255)
-    mask_w = np.ones(img.shape, dtype='uint8')*255
-    cv2.fillPoly(mask_w, contours, 0)
-    masked = cv2.bitwise_and(img, img, mask = mask_b)
-    masked_w = masked+mask_w
+    with span('find_items.contours'):
+        contours,_ = cv2.findContours(thresh_blurred, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
 
     for contour in contours:
-        if cv2.contourArea(contour)/size < 0.001:
+        area = cv2.contourArea(contour)/size
+        if area < MIN_TRAIN_AREA:
             continue
-        if cv2.contourArea(contour)/size < 0.005:
+        if area < MIN_STATION_AREA:
             ctype = 'train'
             padding = int(width/20)
         else:
@@ -49,61 +125,115 @@ def find_items(img, stations=True):
             continue
         c_x = int(moments["m10"] / moments["m00"])
         c_y = int(moments["m01"] / moments["m00"])
-        cropped = masked_w[c_y-padding:c_y+padding, c_x-padding:c_x+padding]
-        color_name = find_color(cropped)
+        candidates.append({'type': ctype, 'x': c_x, 'y': c_y, 'padding': padding, 'contour': contour})
+    return candidates, n_stations, contours
 
-        if ctype == 'train' and color_name == 'white':
-            edges = cv2.Canny(cropped ,50, 150)
-            lines = cv2.HoughLinesP(edges, rho = 1,theta = 1*np.pi/180, threshold = 40, minLineLength = 30, maxLineGap = 0)
-            if lines is not None:
-                continue
 
-        if ctype == 'station':
-            items.append({'x': c_x, 'y': c_y, 'type': 'station', 'color': color_name})
-        else:
-            items.append({'x': c_x, 'y': c_y, 'color': color_name})
-    return items, n_stations
+def classify_candidates(img, candidates, contours, proc_scale=1.0, reject_track=True, workspace=None):
+    """Returns the color names of the candidates.
+    White trains that are part of the track are rejected.
 
+    Args:
+        img (RGB-image): screenshot of the game
+        candidates (list): candidates found by find_candidates
+        contours (list): all contours of the image
+        proc_scale (float, optional): resolution of img relative to the full (750 px high) image
+        reject_track (bool, optional): if False, white trains are not checked for track lines,
+            e.g. for candidates of the background model that cannot be part of the track
+        workspace (Workspace, optional): buffer of the track mask
 
-def find_color(obj):
-    """Returns the color name of the train or station
+    Returns:
+        list: color name of every candidate, None if the candidate is rejected
+    """
+    if len(candidates) == 0:
+        return []
+    with span('find_items.color'):
+        # only the pixels inside the bounding boxes of the candidates are gathered
+        pixels = []
+        labels = []
+        for idx, candidate in enumerate(candidates):
+            x, y, w, h = cv2.boundingRect(candidate['contour'])
+            inside = np.zeros((h, w), dtype=np.uint8)
+            cv2.drawContours(inside, [candidate['contour']], -1, 1, cv2.FILLED, offset=(-x, -y))
+            pick = np.flatnonzero(inside)
+            pixels.append(img[y:y+h, x:x+w].reshape(-1, 3)[pick])
+            labels.append(np.full(len(pick), idx, dtype=np.intp))
+        color_names = classify_labels(np.concatenate(pixels), np.concatenate(labels), len(candidates))
+
+    mask = None
+    for idx, candidate in enumerate(candidates):
+        if not reject_track or candidate['type'] != 'train' or color_names[idx] != 'white':
+            continue
+        with span('find_items.hough'):
+            if mask is None:
+                mask = get_zeros(workspace, 'track_mask', img.shape[:2])
+                cv2.fillPoly(mask, contours, 255)
+            c_x, c_y, padding = candidate['x'], candidate['y'], candidate['padding']
+            cropped = img[c_y-padding:c_y+padding, c_x-padding:c_x+padding].copy()
+            cropped[mask[c_y-padding:c_y+padding, c_x-padding:c_x+padding] == 0] = 255
+            edges = cv2.Canny(cropped, *TRACK_CANNY)
+            lines = cv2.HoughLinesP(edges, rho = 1,theta = 1*np.pi/180, threshold = max(int(TRACK_VOTES*proc_scale), 1), minLineLength = TRACK_MIN_LENGTH*proc_scale, maxLineGap = 0)
+        if lines is not None:
+            color_names[idx] = None
+    return color_names
+
+
+def classify_labels(pixels, label, n_labels):
+    """Returns the color names of all labeled objects in one pass
 
     Args:
-        obj (BGR-image): image of the train or station
+        pixels (array): BGR values of the pixels of all objects, shape (n, 3)
+        label (array): object index 0..n_labels-1 of every pixel
+        n_labels (int): number of objects
 
     Returns:
-        string: color name
+        list: color name of every object
     """
+    if n_labels == 0:
+        return []
+    hsv = cv2.cvtColor(pixels[:, None], cv2.COLOR_BGR2HSV)[:, 0]
+    valid = ~((hsv[:,0] == 0) & (hsv[:,1] == 0) & (hsv[:,2] == 255))
+    hsv = hsv[valid]
+    label = label[valid]
+
+    hue = HUE_LUT[hsv[:,0]].astype(np.intp)
+    hue_counts = np.bincount(label*6+hue, minlength=n_labels*6).reshape(n_labels, 6)[:, 1:]
+    count = np.bincount(label, minlength=n_labels).astype('float')
+    sat = hsv[:,1].astype('float')
+    val = hsv[:,2].astype('float')
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sat_mean = np.bincount(label, sat, n_labels)/count
+        val_mean = np.bincount(label, val, n_labels)/count
+        sat_std = np.sqrt(np.maximum(np.bincount(label, sat*sat, n_labels)/count-sat_mean**2, 0))
+        val_std = np.sqrt(np.maximum(np.bincount(label, val*val, n_labels)/count-val_mean**2, 0))
+
+    return [color_name(hue_counts[k], sat_mean[k], sat_std[k], val_mean[k], val_std[k]) for k in range(n_labels)]
+
+
+def color_name(hue_counts, sat_mean, sat_std, val_mean, val_std):
+    """Returns the color name from the color statistics of a train or station
 
-    hsv = cv2.cvtColor(np.array(obj), cv2.COLOR_BGR2HSV)
-    hsv = hsv.reshape(obj.shape[0]*obj.shape[1],3).astype('float')
-    hsv[(hsv[:,0]==0)&(hsv[:,1]==0)&(hsv[:,2]==255)] = np.nan
-
-    cnt_red = len(np.where((hsv[:,0]>160)&(hsv[:,0]<170))[0])
-    cnt_yellow = len(np.where((hsv[:,0]>=20)&(hsv[:,0]<30))[0])
-    cnt_green = len(np.where((hsv[:,0]>=55)&(hsv[:,0]<65))[0])
-    cnt_violet = len(np.where((hsv[:,0]>=140)&(hsv[:,0]<150))[0])
-    cnt_blue = len(np.where((hsv[:,0]>=95)&(hsv[:,0]<105))[0])
-
-    colors = {
-        'red': cnt_red,
-        'green': cnt_green,
-        'blue': cnt_blue,
-        'yellow': cnt_yellow,
-        'violet': cnt_violet
-    }
-
-    if np.nanmean(hsv[:,1])<50:
-        if np.nanmean(hsv[:,2])>200:
+    Args:
+        hue_counts (array): number of pixels per color in COLOR_NAMES
+        sat_mean (float): mean saturation
+        sat_std (float): standard deviation of the saturation
+        val_mean (float): mean value
+        val_std (float): standard deviation of the value
+
+    Returns:
+        string: color name
+    """
+    if sat_mean<GRAY_SATURATION:
+        if val_mean>WHITE_VALUE:
             return 'white'
         return 'black'
-    if np.nanmean(hsv[:,1])<150 and np.nanstd(hsv[:,1])>95 and np.nanstd(hsv[:,2])<40:
+    if sat_mean<RED_WHITE_SATURATION and sat_std>RED_WHITE_SATURATION_STD and val_std<RED_WHITE_VALUE_STD:
         return 'red-white'
 
-    k = Counter(colors)
+    k = Counter(dict(zip(COLOR_NAMES, hue_counts)))
     main_colors = k.most_common(2)
 
-    if main_colors[1][1] != 0 and main_colors[0][1]/main_colors[1][1] < 4:
+    if main_colors[1][1] != 0 and main_colors[0][1]/main_colors[1][1] < TWO_COLOR_RATIO:
         color1 = main_colors[0][0]+'-'+main_colors[1][0]
         color2 = main_colors[1][0]+'-'+main_colors[0][0]
         if color1 in ['yellow-violet', 'red-blue', 'green-violet']:
@@ -112,7 +242,7 @@ def find_color(obj):
             return color2
 
     if main_colors[0][0] in ['blue', 'green', 'yellow']:
-        if np.nanstd(hsv[:,2])>55:
+        if val_std>BLACK_VALUE_STD:
             return main_colors[0][0]+'-black'
 
     return main_colors[0][0]
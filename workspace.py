@@ -0,0 +1,71 @@
+import numpy as np
+
+
+class Workspace():
+    """Preallocated buffers of the per-frame stages.
+    Capture and detection write into named buffers instead of allocating
+    new images every frame. A buffer is allocated when it is first requested
+    for a frame size, e.g. after the window was found or when the effort
+    level changes the resolution, and reused for every later frame of that
+    size. The buffers are overwritten by the next frame, so a stage must not
+    keep them, and one workspace must not be shared between threads.
+    """
+
+    def __init__(self):
+        self.buffers = {}
+        self.n_allocations = 0
+
+    def get(self, name, shape, dtype=np.uint8):
+        """Returns a buffer with undefined content
+
+        Args:
+            name (string): name of the buffer
+            shape (tuple): shape of the buffer
+            dtype (optional): data type of the buffer
+
+        Returns:
+            array: buffer
+        """
+        key = (name, tuple(shape), np.dtype(dtype))
+        buffer = self.buffers.get(key)
+        if buffer is None:
+            buffer = np.empty(shape, dtype=dtype)
+            self.buffers[key] = buffer
+            self.n_allocations += 1
+        return buffer
+
+
+def get_buffer(workspace, name, shape, dtype=np.uint8):
+    """Returns a buffer of the workspace as dst of an OpenCV function, None without workspace
+
+    Args:
+        workspace (Workspace): workspace or None
+        name (string): name of the buffer
+        shape (tuple): shape of the buffer
+        dtype (optional): data type of the buffer
+
+    Returns:
+        array: buffer with undefined content, None if workspace is None
+    """
+    if workspace is None:
+        return None
+    return workspace.get(name, shape, dtype)
+
+
+def get_zeros(workspace, name, shape, dtype=np.uint8):
+    """Returns a buffer of the workspace filled with zeros, a new array without workspace
+
+    Args:
+        workspace (Workspace): workspace or None
+        name (string): name of the buffer
+        shape (tuple): shape of the buffer
+        dtype (optional): data type of the buffer
+
+    Returns:
+        array: zero buffer
+    """
+    if workspace is None:
+        return np.zeros(shape, dtype=dtype)
+    buffer = workspace.get(name, shape, dtype)
+    buffer.fill(0)
+    return buffer